@@ -60,6 +60,7 @@ from crypturd.rc4 import *
 from crypturd.rsa import *
 from crypturd.sha import *
 from crypturd.test import test_all as selftest
+from crypturd.test import benchmark_all as selfbenchmark
 from crypturd.twotimesig import *
 import crypturd.thinice
 
@@ -67,5 +68,7 @@ import crypturd.thinice
 from crypturd.default import *
 
 # Add default cipher functions
-__all__ += ["encrypt", "decrypt", "hash", "rand", "sign_keypair",
-            "verify", "sign", "DH_keypair", "DH_common_secret"]
+__all__ += ["encrypt", "decrypt", "encrypt_file", "decrypt_file",
+            "encrypt_segmented", "decrypt_segmented", "encrypt_segmented_file",
+            "decrypt_segmented_file", "hash", "rand", "sign_keypair", "verify",
+            "sign", "DH_keypair", "DH_common_secret"]
@@ -21,9 +21,20 @@
 # CBC and CTR mode automatically append a SHA256-HMAC
 
 import os
+import struct
+import multiprocessing
+from binascii import hexlify, unhexlify
 from crypturd import pkcs7
-from crypturd.sha import add_sha256_hmac, check_sha256_hmac, sha256
-from crypturd.common import null_padding, xor_str, RngBase, fixed_length_key
+from crypturd.sha import add_sha256_hmac, check_sha256_hmac
+from crypturd.sha import SHA256_HMAC
+from crypturd.common import xor_str, BufferedRngBase, fixed_length_key
+from crypturd.common import data_length, read_range, stream_file
+
+# NumPy is optional, it is only used to process many blocks in one batch
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 S = [0x63, 0x7C, 0x77, 0x7B, 0xF2, 0x6B, 0x6F, 0xC5, 0x30, 0x01, 0x67,
      0x2B, 0xFE, 0xD7, 0xAB, 0x76, 0xCA, 0x82, 0xC9, 0x7D, 0xFA, 0x59,
@@ -363,321 +374,1078 @@ def MixColumnsInv(block):
             block[i * 4 + 1]] ^ gfp9[block[i * 4 + 2]] ^ gfp14[block[i * 4 + 3]]
     return new_block
 
-
-def advance_counter(counter):
-    number_counter = [ord(c) for c in counter]
-    overflow = True
-    # Update first 64 bits as a big-endian number
-    for i in range(8, -1, -1):
-        if overflow:
-            if number_counter[i] == 255:
-                number_counter[i] = 0
-                overflow = True
-            else:
-                number_counter[i] += 1
-                overflow = False
-    return "".join([chr(c) for c in number_counter])
-
-
-@add_sha256_hmac
-def encrypt_128_cbc(data, key, padding=True, gen_iv=True):
-    key = fixed_length_key(key, 16)
-    if padding:
-        data = pkcs7.add_padding(data, 16)
-        r = ""
-
-    if gen_iv:
+# T-tables merge SubBytes, ShiftRows and MixColumns into four lookups per
+# column. Te0/Td0 hold the multiplied columns, the others are rotations.
+Te0 = [(gfp2[S[x]] << 24) | (S[x] << 16) | (S[x] << 8) | gfp3[S[x]]
+       for x in range(256)]
+Te1 = [((t >> 8) | (t << 24)) & 0xffffffff for t in Te0]
+Te2 = [((t >> 16) | (t << 16)) & 0xffffffff for t in Te0]
+Te3 = [((t >> 24) | (t << 8)) & 0xffffffff for t in Te0]
+
+Td0 = [(gfp14[Si[x]] << 24) | (gfp9[Si[x]] << 16) | (gfp13[Si[x]] << 8) |
+       gfp11[Si[x]] for x in range(256)]
+Td1 = [((t >> 8) | (t << 24)) & 0xffffffff for t in Td0]
+Td2 = [((t >> 16) | (t << 16)) & 0xffffffff for t in Td0]
+Td3 = [((t >> 24) | (t << 8)) & 0xffffffff for t in Td0]
+
+# Engine used by new AES contexts, either "ttable" or "reference"
+ENGINE = "ttable"
+
+
+def round_key_words(round_key):
+    "Pack a 16-byte round key into four big-endian column words"
+    return [(round_key[i] << 24) | (round_key[i + 1] << 16) |
+            (round_key[i + 2] << 8) | round_key[i + 3] for i in range(0, 16, 4)]
+
+
+def advance_counter(counter, n=1):
+    "Add n to the first 72 bits of the counter block as a big-endian number"
+    number_counter = (int(hexlify(counter[:9]), 16) + n) % (1 << 72)
+    return unhexlify("%018x" % number_counter) + counter[9:]
+
+
+# Scalar modes process this many bytes at a time
+SEGMENT_SIZE = 1 << 14
+
+
+def check_out_size(out, offset, size):
+    "Raise ValueError unless out has room for size bytes at offset"
+    if offset < 0 or len(out) < offset + size:
+        raise ValueError("Output buffer of %i bytes has no room for %i bytes at offset %i"
+                         % (len(out), size, offset))
+
+# Use NumPy for batches of at least this many blocks
+USE_NUMPY = numpy is not None
+NUMPY_MIN_BLOCKS = 64
+
+# Building the GHASH tables costs about as much as 50 bitwise
+# multiplications, so a key only gets them after this many blocks
+GHASH_TABLE_BLOCKS = 64
+
+if numpy is not None:
+    np_S = numpy.array(S, dtype=numpy.uint8)
+    np_Si = numpy.array(Si, dtype=numpy.uint8)
+    np_gfp2 = numpy.array(gfp2, dtype=numpy.uint8)
+    np_gfp3 = numpy.array(gfp3, dtype=numpy.uint8)
+    np_gfp9 = numpy.array(gfp9, dtype=numpy.uint8)
+    np_gfp11 = numpy.array(gfp11, dtype=numpy.uint8)
+    np_gfp13 = numpy.array(gfp13, dtype=numpy.uint8)
+    np_gfp14 = numpy.array(gfp14, dtype=numpy.uint8)
+    np_shift_rows = numpy.array(ShiftRows(list(range(16))))
+    np_shift_rows_inv = numpy.array(ShiftRowsInv(list(range(16))))
+
+
+def numpy_mix_columns(state):
+    "MixColumns on a (nblocks, 16) array"
+    a = state.reshape(-1, 4, 4)
+    a0, a1, a2, a3 = a[:, :, 0], a[:, :, 1], a[:, :, 2], a[:, :, 3]
+    return numpy.stack([np_gfp2[a0] ^ np_gfp3[a1] ^ a2 ^ a3,
+                        a0 ^ np_gfp2[a1] ^ np_gfp3[a2] ^ a3,
+                        a0 ^ a1 ^ np_gfp2[a2] ^ np_gfp3[a3],
+                        np_gfp3[a0] ^ a1 ^ a2 ^ np_gfp2[a3]],
+                       axis=2).reshape(-1, 16)
+
+
+def numpy_mix_columns_inv(state):
+    "MixColumnsInv on a (nblocks, 16) array"
+    a = state.reshape(-1, 4, 4)
+    a0, a1, a2, a3 = a[:, :, 0], a[:, :, 1], a[:, :, 2], a[:, :, 3]
+    return numpy.stack([np_gfp14[a0] ^ np_gfp11[a1] ^ np_gfp13[a2] ^ np_gfp9[a3],
+                        np_gfp9[a0] ^ np_gfp14[a1] ^ np_gfp11[a2] ^ np_gfp13[a3],
+                        np_gfp13[a0] ^ np_gfp9[a1] ^ np_gfp14[a2] ^ np_gfp11[a3],
+                        np_gfp11[a0] ^ np_gfp13[a1] ^ np_gfp9[a2] ^ np_gfp14[a3]],
+                       axis=2).reshape(-1, 16)
+
+
+def numpy_encrypt_blocks(round_keys, state):
+    "Encrypt a (nblocks, 16) uint8 array with (rounds + 1, 16) round keys"
+    state = state ^ round_keys[0]
+    for round_key in round_keys[1:-1]:
+        # SubBytes and ShiftRows commute, do both in one lookup
+        state = np_S[state[:, np_shift_rows]]
+        state = numpy_mix_columns(state) ^ round_key
+    return np_S[state[:, np_shift_rows]] ^ round_keys[-1]
+
+
+def numpy_decrypt_blocks(round_keys, state):
+    "Decrypt a (nblocks, 16) uint8 array, round keys in decryption order"
+    state = np_Si[(state ^ round_keys[0])[:, np_shift_rows_inv]]
+    for round_key in round_keys[1:-1]:
+        state = numpy_mix_columns_inv(state ^ round_key)
+        state = np_Si[state[:, np_shift_rows_inv]]
+    return state ^ round_keys[-1]
+
+
+def numpy_counter_blocks(counter, nblocks):
+    "Return a (nblocks, 16) array of consecutive counter blocks"
+    counter = numpy.frombuffer(counter, dtype=numpy.uint8)
+    low = numpy.frombuffer(counter[1:9].tobytes(), dtype=">u8")[0]
+    low = low.astype(numpy.uint64)
+    new_low = low + numpy.arange(nblocks, dtype=numpy.uint64)
+    carry = (new_low < low).astype(numpy.uint8)
+    blocks = numpy.empty((nblocks, 16), dtype=numpy.uint8)
+    blocks[:, 0] = counter[0] + carry
+    blocks[:, 1:9] = new_low.astype(">u8").view(numpy.uint8).reshape(-1, 8)
+    blocks[:, 9:] = counter[9:]
+    return blocks
+
+
+def ghash_powers(h):
+    "H times x**i for i in 0..127"
+    # Multiplying by x is a right shift in the bit-reflected GCM field
+    v = [h]
+    for _ in range(127):
+        h = (h >> 1) ^ (0xe1 << 120 if h & 1 else 0)
+        v.append(h)
+    return v
+
+
+def ghash_tables(h):
+    "Per key GHASH tables, one 256-entry table for each byte of a block"
+    v = ghash_powers(h)
+    tables = []
+    for pos in range(16):
+        t = [0] * 256
+        for k in range(8):
+            t[1 << k] = v[pos * 8 + 7 - k]
+        for b in range(3, 256):
+            if b & (b - 1):
+                t[b] = t[b & (b - 1)] ^ t[b & -b]
+        tables.append(t)
+    return tables
+
+
+def ghash_bitwise(powers, y, data):
+    "ghash without tables, one XOR per set bit of the state"
+    data += "\0" * (-len(data) % 16)
+    for i in range(0, len(data), 16):
+        hi, lo = struct.unpack(">QQ", data[i:i + 16])
+        y ^= (hi << 64) | lo
+        z = 0
+        j = 127
+        while y:
+            if y & 1:
+                z ^= powers[j]
+            y >>= 1
+            j -= 1
+        y = z
+    return y
+
+
+def ghash(tables, y, data):
+    "Absorb data (zero padded to whole blocks) into the GHASH state y"
+    (T0, T1, T2, T3, T4, T5, T6, T7,
+     T8, T9, T10, T11, T12, T13, T14, T15) = tables
+    data += "\0" * (-len(data) % 16)
+    for i in range(0, len(data), 16):
+        hi, lo = struct.unpack(">QQ", data[i:i + 16])
+        y ^= (hi << 64) | lo
+        # y * H is the XOR of the table entries of its 16 bytes
+        y = (T0[y >> 120] ^ T1[(y >> 112) & 255] ^
+             T2[(y >> 104) & 255] ^ T3[(y >> 96) & 255] ^
+             T4[(y >> 88) & 255] ^ T5[(y >> 80) & 255] ^
+             T6[(y >> 72) & 255] ^ T7[(y >> 64) & 255] ^
+             T8[(y >> 56) & 255] ^ T9[(y >> 48) & 255] ^
+             T10[(y >> 40) & 255] ^ T11[(y >> 32) & 255] ^
+             T12[(y >> 24) & 255] ^ T13[(y >> 16) & 255] ^
+             T14[(y >> 8) & 255] ^ T15[y & 255])
+    return y
+
+
+class AESBase():
+
+    "AES block cipher with a key schedule that is only expanded once"
+
+    key_size = 16
+    rounds = 10
+
+    def __init__(self, key, engine=None):
+        # The SHA256-HMAC of the encrypt-then-MAC modes uses the key as given
+        self.hmac_key = key
+        key = fixed_length_key(key, self.key_size)
+        self.key = key
+        fullkey = expand_key(list(map(ord, key)), self.key_size,
+                             16 * (self.rounds + 1))
+        # The final round always uses the last 16 bytes of the expanded
+        # key, for 256-bit keys the expansion overshoots by one block.
+        self.round_keys = [fullkey[n * 16:n * 16 + 16]
+                           for n in range(self.rounds)] + [fullkey[-16:]]
+        # Decryption walks through the round keys backwards
+        self.dec_round_keys = self.round_keys[::-1]
+
+        # Word round keys for the T-table engine. Decryption uses the
+        # equivalent inverse cipher, which needs InvMixColumns applied to
+        # all but the first and last round key.
+        self.enc_words = sum([round_key_words(k)
+                              for k in self.round_keys], [])
+        self.dec_words = sum([round_key_words(k) for k in
+                              self.dec_round_keys[:1] +
+                              [MixColumnsInv(k)
+                               for k in self.dec_round_keys[1:-1]] +
+                              self.dec_round_keys[-1:]], [])
+
+        if engine is None:
+            engine = ENGINE
+        if engine == "ttable":
+            self.encrypt_block = self.encrypt_block_ttable
+            self.decrypt_block = self.decrypt_block_ttable
+        elif engine != "reference":
+            raise Exception("Unknown AES engine")
+        self.engine = engine
+
+        if numpy is not None:
+            self.np_round_keys = numpy.array(self.round_keys, dtype=numpy.uint8)
+            self.np_dec_round_keys = self.np_round_keys[::-1]
+
+    def use_numpy(self, nblocks):
+        "Check if a batch of nblocks is large enough to vectorize"
+        return USE_NUMPY and numpy is not None and nblocks >= NUMPY_MIN_BLOCKS
+
+    def encrypt_block_reference(self, block):
+        "Encrypt a single 16-byte block one transformation at a time"
+        round_keys = self.round_keys
+        block = [ord(b) for b in block]
+        # initial round
+        block = AddRoundKey(block, round_keys[0])
+        for round_key in round_keys[1:-1]:
+            block = SubBytes(block)
+            block = ShiftRows(block)
+            block = MixColumns(block)
+            block = AddRoundKey(block, round_key)
+        # final round
+        block = SubBytes(block)
+        block = ShiftRows(block)
+        block = AddRoundKey(block, round_keys[-1])
+        return "".join([chr(b) for b in block])
+
+    def decrypt_block_reference(self, block):
+        "Decrypt a single 16-byte block one transformation at a time"
+        round_keys = self.dec_round_keys
+        block = [ord(b) for b in block]
+        # undo final round
+        block = AddRoundKey(block, round_keys[0])
+        block = ShiftRowsInv(block)
+        block = SubBytesInv(block)
+        for round_key in round_keys[1:-1]:
+            block = AddRoundKey(block, round_key)
+            block = MixColumnsInv(block)
+            block = ShiftRowsInv(block)
+            block = SubBytesInv(block)
+        # Undo initial round
+        block = AddRoundKey(block, round_keys[-1])
+        return "".join([chr(b) for b in block])
+
+    def encrypt_block_ttable(self, block):
+        "Encrypt a single 16-byte block using 32-bit table lookups"
+        rk = self.enc_words
+        s0, s1, s2, s3 = struct.unpack(">4I", block)
+        s0 ^= rk[0]
+        s1 ^= rk[1]
+        s2 ^= rk[2]
+        s3 ^= rk[3]
+        for i in range(4, len(rk) - 4, 4):
+            t0 = (Te0[s0 >> 24] ^ Te1[(s1 >> 16) & 255] ^
+                  Te2[(s2 >> 8) & 255] ^ Te3[s3 & 255] ^ rk[i])
+            t1 = (Te0[s1 >> 24] ^ Te1[(s2 >> 16) & 255] ^
+                  Te2[(s3 >> 8) & 255] ^ Te3[s0 & 255] ^ rk[i + 1])
+            t2 = (Te0[s2 >> 24] ^ Te1[(s3 >> 16) & 255] ^
+                  Te2[(s0 >> 8) & 255] ^ Te3[s1 & 255] ^ rk[i + 2])
+            s3 = (Te0[s3 >> 24] ^ Te1[(s0 >> 16) & 255] ^
+                  Te2[(s1 >> 8) & 255] ^ Te3[s2 & 255] ^ rk[i + 3])
+            s0, s1, s2 = t0, t1, t2
+        # final round (no MixColumns)
+        return struct.pack(
+            ">4I",
+            ((S[s0 >> 24] << 24) | (S[(s1 >> 16) & 255] << 16) |
+             (S[(s2 >> 8) & 255] << 8) | S[s3 & 255]) ^ rk[-4],
+            ((S[s1 >> 24] << 24) | (S[(s2 >> 16) & 255] << 16) |
+             (S[(s3 >> 8) & 255] << 8) | S[s0 & 255]) ^ rk[-3],
+            ((S[s2 >> 24] << 24) | (S[(s3 >> 16) & 255] << 16) |
+             (S[(s0 >> 8) & 255] << 8) | S[s1 & 255]) ^ rk[-2],
+            ((S[s3 >> 24] << 24) | (S[(s0 >> 16) & 255] << 16) |
+             (S[(s1 >> 8) & 255] << 8) | S[s2 & 255]) ^ rk[-1])
+
+    def decrypt_block_ttable(self, block):
+        "Decrypt a single 16-byte block using 32-bit table lookups"
+        rk = self.dec_words
+        s0, s1, s2, s3 = struct.unpack(">4I", block)
+        s0 ^= rk[0]
+        s1 ^= rk[1]
+        s2 ^= rk[2]
+        s3 ^= rk[3]
+        for i in range(4, len(rk) - 4, 4):
+            t0 = (Td0[s0 >> 24] ^ Td1[(s3 >> 16) & 255] ^
+                  Td2[(s2 >> 8) & 255] ^ Td3[s1 & 255] ^ rk[i])
+            t1 = (Td0[s1 >> 24] ^ Td1[(s0 >> 16) & 255] ^
+                  Td2[(s3 >> 8) & 255] ^ Td3[s2 & 255] ^ rk[i + 1])
+            t2 = (Td0[s2 >> 24] ^ Td1[(s1 >> 16) & 255] ^
+                  Td2[(s0 >> 8) & 255] ^ Td3[s3 & 255] ^ rk[i + 2])
+            s3 = (Td0[s3 >> 24] ^ Td1[(s2 >> 16) & 255] ^
+                  Td2[(s1 >> 8) & 255] ^ Td3[s0 & 255] ^ rk[i + 3])
+            s0, s1, s2 = t0, t1, t2
+        # undo initial round (no InvMixColumns)
+        return struct.pack(
+            ">4I",
+            ((Si[s0 >> 24] << 24) | (Si[(s3 >> 16) & 255] << 16) |
+             (Si[(s2 >> 8) & 255] << 8) | Si[s1 & 255]) ^ rk[-4],
+            ((Si[s1 >> 24] << 24) | (Si[(s0 >> 16) & 255] << 16) |
+             (Si[(s3 >> 8) & 255] << 8) | Si[s2 & 255]) ^ rk[-3],
+            ((Si[s2 >> 24] << 24) | (Si[(s1 >> 16) & 255] << 16) |
+             (Si[(s0 >> 8) & 255] << 8) | Si[s3 & 255]) ^ rk[-2],
+            ((Si[s3 >> 24] << 24) | (Si[(s2 >> 16) & 255] << 16) |
+             (Si[(s1 >> 8) & 255] << 8) | Si[s0 & 255]) ^ rk[-1])
+
+    encrypt_block = encrypt_block_reference
+    decrypt_block = decrypt_block_reference
+
+    # The *_into methods write their output into a caller supplied
+    # bytearray (or other writable buffer) at the given offset, the other
+    # methods return a new string. Scalar paths work on SEGMENT_SIZE
+    # bytes at a time so the temporary strings stay small.
+
+    def encrypt_blocks_into(self, out, data, offset=0):
+        "Encrypt a string of whole blocks independently of each other"
+        check_out_size(out, offset, len(data))
+        if self.use_numpy(len(data) // 16):
+            state = numpy.frombuffer(data, dtype=numpy.uint8).reshape(-1, 16)
+            view = numpy.frombuffer(out, dtype=numpy.uint8)
+            view[offset:offset + len(data)] = numpy_encrypt_blocks(
+                self.np_round_keys, state).reshape(-1)
+            return
+        encrypt_block = self.encrypt_block
+        for i in range(0, len(data), 16):
+            out[offset + i:offset + i + 16] = encrypt_block(data[i:i + 16])
+
+    def decrypt_blocks_into(self, out, data, offset=0):
+        "Decrypt a string of whole blocks independently of each other"
+        check_out_size(out, offset, len(data))
+        if self.use_numpy(len(data) // 16):
+            state = numpy.frombuffer(data, dtype=numpy.uint8).reshape(-1, 16)
+            view = numpy.frombuffer(out, dtype=numpy.uint8)
+            view[offset:offset + len(data)] = numpy_decrypt_blocks(
+                self.np_dec_round_keys, state).reshape(-1)
+            return
+        decrypt_block = self.decrypt_block
+        for i in range(0, len(data), 16):
+            out[offset + i:offset + i + 16] = decrypt_block(data[i:i + 16])
+
+    def encrypt_blocks(self, data):
+        out = bytearray(len(data))
+        self.encrypt_blocks_into(out, data)
+        return bytes(out)
+
+    def decrypt_blocks(self, data):
+        out = bytearray(len(data))
+        self.decrypt_blocks_into(out, data)
+        return bytes(out)
+
+    def encrypt_ecb(self, data, padding=True):
+        if padding:
+            data = pkcs7.add_padding(data, 16)
+        return self.encrypt_blocks(data)
+
+    def decrypt_ecb(self, data, padding=True):
+        r = self.decrypt_blocks(data)
+        if padding:
+            return pkcs7.remove_padding(r)
+        else:
+            return r
+
+    def encrypt_cbc_into(self, out, data, iv, offset=0):
+        "CBC encryption of whole blocks, the iv is not written to out"
+        check_out_size(out, offset, len(data))
+        encrypt_block = self.encrypt_block
+        for i in range(0, len(data), 16):
+            iv = encrypt_block(xor_str(data[i:i + 16], iv))
+            out[offset + i:offset + i + 16] = iv
+
+    def encrypt_cbc(self, data, iv, padding=True):
+        "CBC encryption, the iv is not included in the output"
+        if padding:
+            data = pkcs7.add_padding(data, 16)
+        out = bytearray(len(data))
+        self.encrypt_cbc_into(out, data, iv)
+        return bytes(out)
+
+    def decrypt_cbc_into(self, out, data, iv, offset=0, pool=None):
+        "CBC decryption of whole blocks, padding is left in place"
+        # pool is an optional AESPool for the same key, the caller owns it
+        check_out_size(out, offset, len(data))
+        # Each plaintext block only depends on two ciphertext blocks, so
+        # large inputs are decrypted as a batch and then XOR-ed with the
+        # ciphertext shifted by one block in a single pass.
+        if pool is not None:
+            decrypted = pool.decrypt_blocks(data)
+            out[offset:offset + len(data)] = xor_str(decrypted, iv + data[:-16])
+        elif self.use_numpy(len(data) // 16):
+            self.decrypt_blocks_into(out, data, offset)
+            view = numpy.frombuffer(out, dtype=numpy.uint8)
+            view[offset:offset + len(data)] ^= numpy.frombuffer(
+                iv + data[:-16], dtype=numpy.uint8)
+        else:
+            decrypt_block = self.decrypt_block
+            for i in range(0, len(data), SEGMENT_SIZE):
+                segment = data[i:i + SEGMENT_SIZE]
+                decrypted = "".join([decrypt_block(segment[j:j + 16])
+                                     for j in range(0, len(segment), 16)])
+                out[offset + i:offset + i + len(segment)] = xor_str(
+                    decrypted, iv + segment[:-16])
+                iv = segment[-16:]
+
+    def decrypt_cbc(self, data, iv, padding=True, pool=None):
+        out = bytearray(len(data))
+        self.decrypt_cbc_into(out, data, iv, pool=pool)
+        r = bytes(out)
+        if padding:
+            return pkcs7.remove_padding(r)
+        else:
+            return r
+
+    def ctr_into(self, out, data, counter, offset=0):
+        "CTR mode keystream applied to data, the same for both directions"
+        check_out_size(out, offset, len(data))
+        nblocks = (len(data) + 15) // 16
+        if self.use_numpy(nblocks):
+            keystream = numpy_encrypt_blocks(
+                self.np_round_keys, numpy_counter_blocks(counter, nblocks))
+            view = numpy.frombuffer(out, dtype=numpy.uint8)
+            view[offset:offset + len(data)] = numpy.frombuffer(
+                data, dtype=numpy.uint8) ^ keystream.reshape(-1)[:len(data)]
+            return
+        encrypt_block = self.encrypt_block
+        number_counter = int(hexlify(counter[:9]), 16)
+        tail = counter[9:]
+        for i in range(0, len(data), SEGMENT_SIZE):
+            segment = data[i:i + SEGMENT_SIZE]
+            keystream = "".join([
+                encrypt_block(unhexlify("%018x" % ((number_counter + j) % (1 << 72))) + tail)
+                for j in range(i // 16, (i + len(segment) + 15) // 16)])
+            out[offset + i:offset + i + len(segment)] = xor_str(segment, keystream)
+
+    def ctr(self, data, counter):
+        out = bytearray(len(data))
+        self.ctr_into(out, data, counter)
+        return bytes(out)
+
+    encrypt_ctr = ctr
+    decrypt_ctr = ctr
+
+    def hmac_context(self):
+        "SHA256_HMAC of the key, built on first use and kept with the context"
+        if not hasattr(self, "hmac"):
+            self.hmac = SHA256_HMAC(self.hmac_key)
+        return self.hmac
+
+    def add_hmac(self, ciphertext):
+        return ciphertext + self.hmac_context().mac(ciphertext)
+
+    def check_hmac(self, data):
+        "Strip the SHA256-HMAC from data, raises an exception if it is invalid"
+        ciphertext, hmac = data[:-32], data[-32:]
+        if hmac != self.hmac_context().mac(ciphertext):
+            raise Exception("Invalid HMAC")
+        return ciphertext
+
+    def encrypt_ctr_hmac(self, data):
+        "CTR mode with a random counter, counter || ciphertext || SHA256-HMAC"
+        counter = os.urandom(16)
+        return self.add_hmac(counter + self.ctr(data, counter))
+
+    def decrypt_ctr_hmac(self, data):
+        data = self.check_hmac(data)
+        return self.ctr(data[16:], data[:16])
+
+    def encrypt_cbc_hmac(self, data, padding=True, gen_iv=True):
+        "CBC mode with a random IV, iv || ciphertext || SHA256-HMAC"
+        if gen_iv:
+            iv = os.urandom(16)
+            return self.add_hmac(iv + self.encrypt_cbc(data, iv, padding))
+        else:
+            return self.add_hmac(self.encrypt_cbc(data, "\0" * 16, padding))
+
+    def decrypt_cbc_hmac(self, data, padding=True, gen_iv=True, pool=None):
+        data = self.check_hmac(data)
+        if gen_iv:
+            return self.decrypt_cbc(data[16:], data[:16], padding, pool)
+        else:
+            return self.decrypt_cbc(data, "\0" * 16, padding, pool)
+
+    def hmac_slices(self, buf, start, end):
+        "SHA256-HMAC of buf[start:end], read SEGMENT_SIZE bytes at a time"
+        return self.hmac_context().mac_chunks(
+            bytes(buf[i:min(i + SEGMENT_SIZE, end)])
+            for i in range(start, end, SEGMENT_SIZE))
+
+    def check_hmac_slices(self, data):
+        if len(data) < 48 or data[-32:] != self.hmac_slices(data, 0, len(data) - 32):
+            raise Exception("Invalid HMAC")
+
+    def encrypt_ctr_hmac_into(self, out, data, offset=0):
+        "encrypt_ctr_hmac into out[offset:], returns the number of bytes written"
+        check_out_size(out, offset, len(data) + 48)
+        counter = os.urandom(16)
+        out[offset:offset + 16] = counter
+        for i in range(0, len(data), SEGMENT_SIZE):
+            self.ctr_into(out, data[i:i + SEGMENT_SIZE],
+                          advance_counter(counter, i // 16), offset + 16 + i)
+        end = offset + 16 + len(data)
+        out[end:end + 32] = self.hmac_slices(out, offset, end)
+        return len(data) + 48
+
+    def decrypt_ctr_hmac_into(self, out, data, offset=0):
+        "decrypt_ctr_hmac into out[offset:], returns the plaintext length"
+        check_out_size(out, offset, max(len(data) - 48, 0))
+        self.check_hmac_slices(data)
+        counter = data[:16]
+        for i in range(16, len(data) - 32, SEGMENT_SIZE):
+            self.ctr_into(out, data[i:min(i + SEGMENT_SIZE, len(data) - 32)],
+                          advance_counter(counter, (i - 16) // 16), offset + i - 16)
+        return len(data) - 48
+
+    def encrypt_cbc_hmac_into(self, out, data, offset=0):
+        "encrypt_cbc_hmac into out[offset:], returns the number of bytes written"
+        check_out_size(out, offset, len(data) - len(data) % 16 + 64)
         iv = os.urandom(16)
-        r = iv
-    else:
+        out[offset:offset + 16] = iv
+        # Whole blocks are read in place, only the last one is padded
+        body = len(data) - len(data) % 16
+        for i in range(0, body, SEGMENT_SIZE):
+            segment = data[i:min(i + SEGMENT_SIZE, body)]
+            self.encrypt_cbc_into(out, segment, iv, offset + 16 + i)
+            iv = bytes(out[offset + i + len(segment):offset + 16 + i + len(segment)])
+        self.encrypt_cbc_into(out, pkcs7.add_padding(data[body:], 16), iv,
+                              offset + 16 + body)
+        end = offset + 32 + body
+        out[end:end + 32] = self.hmac_slices(out, offset, end)
+        return body + 64
+
+    def decrypt_cbc_hmac_into(self, out, data, offset=0):
+        "decrypt_cbc_hmac into out[offset:], returns the plaintext length"
+        check_out_size(out, offset, max(len(data) - 48, 0))
+        self.check_hmac_slices(data)
+        end = len(data) - 32
+        if end < 32 or (end - 16) % 16:
+            raise Exception("Invalid padding")
+        for i in range(16, end, SEGMENT_SIZE):
+            self.decrypt_cbc_into(out, data[i:min(i + SEGMENT_SIZE, end)],
+                                  data[i - 16:i], offset + i - 16)
+        # The padding stays in out past the returned length
+        last = bytes(out[offset + end - 32:offset + end - 16])
+        return end - 32 + len(pkcs7.remove_padding(last))
+
+    def cbc_mac(self, data):
+        data = pkcs7.add_padding(data, 16)
         iv = "\0" * 16
-        r = ""
-
-    for i in range(0, len(data), 16):
-        cipherblock = aes128enc(xor_str(data[i:i + 16], iv), key)
-        r += cipherblock
-        iv = cipherblock
-    return r
+        for i in range(0, len(data), 16):
+            iv = self.encrypt_block(xor_str(data[i:i + 16], iv))
+        return iv
+
+    def gcm_into(self, out, data, nonce, offset=0, first_block=2):
+        "GCM keystream for a 96-bit nonce applied to data"
+        check_out_size(out, offset, len(data))
+        for i in range(0, len(data), SEGMENT_SIZE):
+            segment = data[i:i + SEGMENT_SIZE]
+            blocks = "".join([nonce + struct.pack(">I", (first_block + j) & 0xffffffff)
+                              for j in range(i // 16, (i + len(segment) + 15) // 16)])
+            out[offset + i:offset + i + len(segment)] = xor_str(
+                self.encrypt_blocks(blocks), segment)
+
+    def gcm(self, data, nonce, first_block=2):
+        out = bytearray(len(data))
+        self.gcm_into(out, data, nonce, 0, first_block)
+        return bytes(out)
+
+    def gcm_tag(self, ciphertext, nonce, aad):
+        if not hasattr(self, "ghash_h"):
+            hi, lo = struct.unpack(">QQ", self.encrypt_block("\0" * 16))
+            self.ghash_h = (hi << 64) | lo
+            self.ghash_powers = ghash_powers(self.ghash_h)
+            self.ghash_blocks = 0
+        # Short messages under a fresh key skip building the tables
+        self.ghash_blocks += (len(aad) + 15) // 16 + (len(ciphertext) + 15) // 16 + 1
+        if hasattr(self, "ghash_tables"):
+            f, key = ghash, self.ghash_tables
+        elif self.ghash_blocks >= GHASH_TABLE_BLOCKS:
+            self.ghash_tables = ghash_tables(self.ghash_h)
+            f, key = ghash, self.ghash_tables
+        else:
+            f, key = ghash_bitwise, self.ghash_powers
+        y = f(key, 0, aad)
+        y = f(key, y, ciphertext)
+        y = f(key, y, struct.pack(">QQ", len(aad) * 8, len(ciphertext) * 8))
+        return self.gcm(unhexlify("%032x" % y), nonce, 1)
+
+    def encrypt_gcm(self, data, nonce, aad=""):
+        "GCM encryption, returns the ciphertext followed by a 128-bit tag"
+        ciphertext = self.gcm(data, nonce)
+        return ciphertext + self.gcm_tag(ciphertext, nonce, aad)
+
+    def decrypt_gcm(self, data, nonce, aad=""):
+        ciphertext, tag = data[:-16], data[-16:]
+        if len(tag) != 16 or tag != self.gcm_tag(ciphertext, nonce, aad):
+            raise Exception("Invalid tag (GCM)")
+        return self.gcm(ciphertext, nonce)
+
+    def seal_gcm(self, data, aad=""):
+        "GCM with a random nonce, nonce || ciphertext || tag"
+        nonce = os.urandom(12)
+        return nonce + self.encrypt_gcm(data, nonce, aad)
+
+    def open_gcm(self, data, aad=""):
+        return self.decrypt_gcm(data[12:], data[:12], aad)
+
+
+class AES128(AESBase):
+
+    "AES with a 128-bit key"
+
+    key_size = 16
+    rounds = 10
+
+
+class AES256(AESBase):
+
+    "AES with a 256-bit key"
+
+    key_size = 32
+    rounds = 14
 
 
-@check_sha256_hmac
-def decrypt_128_cbc(data, key, padding=True, gen_iv=True):
-    key = fixed_length_key(key, 16)
-    r = ""
-    if gen_iv:
-        iv = data[:16]
-        data = data[16:]
-    else:
-        iv = "\0" * 16
+def encrypt_128_cbc(data, key, padding=True, gen_iv=True):
+    return AES128(key).encrypt_cbc_hmac(data, padding, gen_iv)
 
-    for i in range(0, len(data), 16):
-        cipherblock = data[i:i + 16]
-        r += xor_str(aes128dec(cipherblock, key), iv)
-        iv = cipherblock
 
-    if padding:
-        return pkcs7.remove_padding(r)
-    else:
-        return r
+def decrypt_128_cbc(data, key, padding=True, gen_iv=True):
+    return AES128(key).decrypt_cbc_hmac(data, padding, gen_iv)
 
 
 def encrypt_128_ecb(data, key, padding=True):
-    key = fixed_length_key(key, 16)
-    r = ""
-    if padding:
-        data = pkcs7.add_padding(data, 16)
-    for i in range(0, len(data), 16):
-        r += aes128enc(data[i:i + 16], key)
-    return r
+    return AES128(key).encrypt_ecb(data, padding)
 
 
 def decrypt_128_ecb(data, key, padding=True):
-    key = fixed_length_key(key, 16)
+    return AES128(key).decrypt_ecb(data, padding)
 
-    r = ""
-    for i in range(0, len(data), 16):
-        r += aes128dec(data[i:i + 16], key)
-    if padding:
-        return pkcs7.remove_padding(r)
-    else:
-        return r
 
-
-@add_sha256_hmac
 def encrypt_128_ctr(data, key):
-    key = fixed_length_key(key, 16)
-    counter = os.urandom(16)
-    r = counter
-    for i in range(0, len(data), 16):
-        encrypted_counter = aes128enc(counter, key)
-        r += xor_str(encrypted_counter, data[i:i + 16])
-        counter = advance_counter(counter)
-    return r
+    return AES128(key).encrypt_ctr_hmac(data)
 
 
-@check_sha256_hmac
 def decrypt_128_ctr(data, key):
-    key = fixed_length_key(key, 16)
-    counter = data[:16]
-    data = data[16:]
-    r = ""
-    for i in range(0, len(data), 16):
-        encrypted_counter = aes128enc(counter, key)
-        r += xor_str(encrypted_counter, data[i:i + 16])
-        counter = advance_counter(counter)
-    return r
+    return AES128(key).decrypt_ctr_hmac(data)
 
 
 def aes128enc(block, key):
-    # expand key
-    fullkey = aes128round_keys(key)
-    block = [ord(b) for b in block]
-    # initial round
-    block = AddRoundKey(block, fullkey[:16])
-    # Rounds 2-11
-    for n in range(1, 10):
-        block = SubBytes(block)
-        block = ShiftRows(block)
-        block = MixColumns(block)
-        block = AddRoundKey(block, fullkey[n * 16:n * 16 + 16])
-    # final round
-    block = SubBytes(block)
-    block = ShiftRows(block)
-    block = AddRoundKey(block, fullkey[-16:])
-    return "".join([chr(b) for b in block])
+    return AES128(key).encrypt_block(block)
 
 
 def aes128dec(block, key):
-    # expand key
-    fullkey = aes128round_keys(key)
-    block = [ord(b) for b in block]
+    return AES128(key).decrypt_block(block)
 
-    # undo final round
-    final_round_key = fullkey[-16:]
 
-    block = AddRoundKey(block, final_round_key)
-    block = ShiftRowsInv(block)
-    block = SubBytesInv(block)
+def encrypt_256_ctr(data, key):
+    return AES256(key).encrypt_ctr_hmac(data)
 
-    for n in range(9, 0, -1):
-        round_key = fullkey[n * 16:n * 16 + 16]
 
-        block = AddRoundKey(block, round_key)
-        block = MixColumnsInv(block)
-        block = ShiftRowsInv(block)
-        block = SubBytesInv(block)
+def decrypt_256_ctr(data, key):
+    return AES256(key).decrypt_ctr_hmac(data)
+
+
+def encrypt_256_cbc(data, key, padding=True, gen_iv=True):
+    return AES256(key).encrypt_cbc_hmac(data, padding, gen_iv)
 
-    # Undo initial round
-    block = AddRoundKey(block, fullkey[:16])
 
-    return "".join([chr(b) for b in block])
+def decrypt_256_cbc(data, key, padding=True, gen_iv=True):
+    return AES256(key).decrypt_cbc_hmac(data, padding, gen_iv)
+
+
+def encrypt_256_ecb(data, key, padding=True):
+    return AES256(key).encrypt_ecb(data, padding)
+
+
+def decrypt_256_ecb(data, key, padding=True):
+    return AES256(key).decrypt_ecb(data, padding)
+
+
+# GCM replaces the SHA256-HMAC by GHASH, the format is
+# 96-bit nonce || ciphertext || 128-bit tag. Keep an AES128/AES256
+# context and use seal_gcm/open_gcm to encrypt many messages under a key.
+
+def encrypt_128_gcm(data, key, aad=""):
+    return AES128(key).seal_gcm(data, aad)
+
+
+def decrypt_128_gcm(data, key, aad=""):
+    return AES128(key).open_gcm(data, aad)
+
+
+def encrypt_256_gcm(data, key, aad=""):
+    return AES256(key).seal_gcm(data, aad)
+
+
+def decrypt_256_gcm(data, key, aad=""):
+    return AES256(key).open_gcm(data, aad)
+
+
+def aes256enc(block, key):
+    return AES256(key).encrypt_block(block)
+
+
+def aes256dec(block, key):
+    return AES256(key).decrypt_block(block)
+
+
+# Worker processes for the parallel CTR mode. Every block of keystream
+# only depends on its counter, so the input is split into segments that
+# start at a block boundary and each worker runs the counter from there.
+PARALLEL_PROCESSES = None       # None uses one process per cpu
+PARALLEL_SEGMENT_SIZE = 1 << 16
+
+worker_ctx = None
+
+
+def init_aes_worker(cls, key, engine=None):
+    "Expand the key once per worker process"
+    global worker_ctx
+    worker_ctx = cls(key, engine)
+
+
+def ctr_worker(args):
+    data, counter = args
+    return worker_ctx.ctr(data, counter)
+
+
+def decrypt_blocks_worker(data):
+    return worker_ctx.decrypt_blocks(data)
+
+
+class AESPool():
+
+    "A pool of worker processes that share one warm AES key schedule"
+
+    def __init__(self, cls, key, processes=None, engine=None):
+        if processes is None:
+            processes = PARALLEL_PROCESSES
+        self.pool = multiprocessing.Pool(processes, init_aes_worker,
+                                         (cls, key, engine))
+
+    def ctr(self, data, counter, segment_size=None):
+        "CTR mode keystream applied to data, segments run in parallel"
+        if segment_size is None:
+            segment_size = PARALLEL_SEGMENT_SIZE
+        segment_size -= segment_size % 16
+        jobs = [(data[i:i + segment_size], advance_counter(counter, i // 16))
+                for i in range(0, len(data), segment_size)]
+        return "".join(self.pool.map(ctr_worker, jobs))
+
+    def decrypt_blocks(self, data, segment_size=None):
+        "Decrypt a string of whole blocks, segments run in parallel"
+        if segment_size is None:
+            segment_size = PARALLEL_SEGMENT_SIZE
+        segment_size -= segment_size % 16
+        jobs = [data[i:i + segment_size]
+                for i in range(0, len(data), segment_size)]
+        return "".join(self.pool.map(decrypt_blocks_worker, jobs))
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+def parallel_ctr(cls, key, data, counter, engine=None):
+    pool = AESPool(cls, key, engine=engine)
+    try:
+        return pool.ctr(data, counter)
+    finally:
+        pool.close()
+
+
+def parallel_decrypt_blocks(cls, key, data, engine=None):
+    pool = AESPool(cls, key, engine=engine)
+    try:
+        return pool.decrypt_blocks(data)
+    finally:
+        pool.close()
 
 
 @add_sha256_hmac
-def encrypt_256_ctr(data, key):
-    key = fixed_length_key(key, 32)
+def encrypt_128_ctr_parallel(data, key):
     counter = os.urandom(16)
-    r = counter
-    for i in range(0, len(data), 16):
-        encrypted_counter = aes256enc(counter, key)
-        r += xor_str(encrypted_counter, data[i:i + 16])
-        counter = advance_counter(counter)
-    return r
+    return counter + parallel_ctr(AES128, key, data, counter)
 
 
 @check_sha256_hmac
-def decrypt_256_ctr(data, key):
-    key = fixed_length_key(key, 32)
-    counter = data[:16]
-    data = data[16:]
-    r = ""
-    for i in range(0, len(data), 16):
-        encrypted_counter = aes256enc(counter, key)
-        r += xor_str(encrypted_counter, data[i:i + 16])
-        counter = advance_counter(counter)
-    return r
+def decrypt_128_ctr_parallel(data, key):
+    return parallel_ctr(AES128, key, data[16:], data[:16])
 
 
 @add_sha256_hmac
-def encrypt_256_cbc(data, key, padding=True, gen_iv=True):
-    key = fixed_length_key(key, 32)
-    if padding:
-        data = pkcs7.add_padding(data, 16)
-        r = ""
+def encrypt_256_ctr_parallel(data, key):
+    counter = os.urandom(16)
+    return counter + parallel_ctr(AES256, key, data, counter)
 
-    if gen_iv:
-        iv = os.urandom(16)
-        r = iv
-    else:
-        iv = "\0" * 16
-        r = ""
 
-    for i in range(0, len(data), 16):
-        cipherblock = aes256enc(xor_str(data[i:i + 16], iv), key)
-        r += cipherblock
-        iv = cipherblock
-    return r
+@check_sha256_hmac
+def decrypt_256_ctr_parallel(data, key):
+    return parallel_ctr(AES256, key, data[16:], data[:16])
 
 
-@check_sha256_hmac
-def decrypt_256_cbc(data, key, padding=True, gen_iv=True):
-    key = fixed_length_key(key, 32)
-    r = ""
-    if gen_iv:
-        iv = data[:16]
-        data = data[16:]
-    else:
-        iv = "\0" * 16
+# Streaming versions of the CTR and CBC modes. They produce and accept the
+# same IV || ciphertext || SHA256-HMAC layout as the one-shot functions,
+# but only keep a few blocks in memory. Decryptors return plaintext before
+# the HMAC is checked, finalize() raises an exception if it is invalid and
+# everything returned up to then must be discarded.
 
-    for i in range(0, len(data), 16):
-        cipherblock = data[i:i + 16]
-        r += xor_str(aes256dec(cipherblock, key), iv)
-        iv = cipherblock
 
-    if padding:
-        return pkcs7.remove_padding(r)
-    else:
+class CTREncryptor():
+
+    "Incremental encrypt_256_ctr (or encrypt_128_ctr with cls=AES128)"
+
+    def __init__(self, key, cls=AES256):
+        self.ctx = cls(key)
+        self.hmac = SHA256_HMAC(key)
+        self.counter = os.urandom(16)
+        self.header = self.counter
+        self.buf = ""
+
+    def update(self, data):
+        data = self.buf + data
+        end = len(data) - len(data) % 16
+        r = self.header + self.ctx.ctr(data[:end], self.counter)
+        self.counter = advance_counter(self.counter, end // 16)
+        self.header = ""
+        self.buf = data[end:]
+        self.hmac.update(r)
         return r
 
+    def finalize(self):
+        r = self.header + self.ctx.ctr(self.buf, self.counter)
+        self.hmac.update(r)
+        return r + self.hmac.digest()
 
-def encrypt_256_ecb(data, key, padding=True):
-    key = fixed_length_key(key, 32)
-    r = ""
-    if padding:
-        data = pkcs7.add_padding(data, 16)
-    for i in range(0, len(data), 16):
-        r += aes256enc(data[i:i + 16], key)
-    return r
 
+class CTRDecryptor():
 
-def decrypt_256_ecb(data, key, padding=True):
-    key = fixed_length_key(key, 32)
-    r = ""
-    for i in range(0, len(data), 16):
-        r += aes256dec(data[i:i + 16], key)
-    if padding:
-        return pkcs7.remove_padding(r)
-    else:
+    "Incremental decrypt_256_ctr (or decrypt_128_ctr with cls=AES128)"
+
+    def __init__(self, key, cls=AES256):
+        self.ctx = cls(key)
+        self.hmac = SHA256_HMAC(key)
+        self.counter = None
+        self.buf = ""
+
+    def update(self, data):
+        data = self.buf + data
+        if self.counter is None:
+            if len(data) < 16:
+                self.buf = data
+                return ""
+            self.counter = data[:16]
+            self.hmac.update(self.counter)
+            data = data[16:]
+        # Hold back anything that could be part of the HMAC
+        end = max(len(data) - 32, 0)
+        end -= end % 16
+        self.hmac.update(data[:end])
+        r = self.ctx.ctr(data[:end], self.counter)
+        self.counter = advance_counter(self.counter, end // 16)
+        self.buf = data[end:]
         return r
 
+    def finalize(self):
+        if self.counter is None or len(self.buf) < 32:
+            raise Exception("Invalid HMAC")
+        self.hmac.update(self.buf[:-32])
+        if self.buf[-32:] != self.hmac.digest():
+            raise Exception("Invalid HMAC")
+        return self.ctx.ctr(self.buf[:-32], self.counter)
 
-def aes256enc(block, key):
-    # expand key
-    fullkey = aes256round_keys(key)
-    block = [ord(b) for b in block]
-    # initial round
-    block = AddRoundKey(block, fullkey[:16])
-    # Rounds 2-11
-    for n in range(1, 14):
-        block = SubBytes(block)
-        block = ShiftRows(block)
-        block = MixColumns(block)
-        block = AddRoundKey(block, fullkey[n * 16:n * 16 + 16])
-    # final round
-    block = SubBytes(block)
-    block = ShiftRows(block)
-    block = AddRoundKey(block, fullkey[-16:])
-    return "".join([chr(b) for b in block])
 
+class CBCEncryptor():
 
-def aes256dec(block, key):
-    # expand key
-    fullkey = aes256round_keys(key)
-    block = [ord(b) for b in block]
+    "Incremental encrypt_256_cbc (or encrypt_128_cbc with cls=AES128)"
 
-    # undo final round
-    final_round_key = fullkey[-16:]
+    def __init__(self, key, cls=AES256):
+        self.ctx = cls(key)
+        self.hmac = SHA256_HMAC(key)
+        self.iv = os.urandom(16)
+        self.header = self.iv
+        self.buf = ""
 
-    block = AddRoundKey(block, final_round_key)
-    block = ShiftRowsInv(block)
-    block = SubBytesInv(block)
+    def update(self, data):
+        data = self.buf + data
+        end = len(data) - len(data) % 16
+        r = self.ctx.encrypt_cbc(data[:end], self.iv, False)
+        if r:
+            self.iv = r[-16:]
+        r = self.header + r
+        self.header = ""
+        self.buf = data[end:]
+        self.hmac.update(r)
+        return r
 
-    for n in range(13, 0, -1):
-        round_key = fullkey[n * 16:n * 16 + 16]
+    def finalize(self):
+        r = self.header + self.ctx.encrypt_cbc(self.buf, self.iv)
+        self.hmac.update(r)
+        return r + self.hmac.digest()
+
+
+class CBCDecryptor():
+
+    "Incremental decrypt_256_cbc (or decrypt_128_cbc with cls=AES128)"
+
+    def __init__(self, key, cls=AES256):
+        self.ctx = cls(key)
+        self.hmac = SHA256_HMAC(key)
+        self.iv = None
+        self.buf = ""
+
+    def update(self, data):
+        data = self.buf + data
+        if self.iv is None:
+            if len(data) < 16:
+                self.buf = data
+                return ""
+            self.iv = data[:16]
+            self.hmac.update(self.iv)
+            data = data[16:]
+        # Hold back the HMAC and the last block, which holds the padding
+        end = max(len(data) - 48, 0)
+        end -= end % 16
+        self.hmac.update(data[:end])
+        r = self.ctx.decrypt_cbc(data[:end], self.iv, False)
+        if end:
+            self.iv = data[end - 16:end]
+        self.buf = data[end:]
+        return r
+
+    def finalize(self):
+        if self.iv is None or len(self.buf) < 32:
+            raise Exception("Invalid HMAC")
+        self.hmac.update(self.buf[:-32])
+        if self.buf[-32:] != self.hmac.digest():
+            raise Exception("Invalid HMAC")
+        return self.ctx.decrypt_cbc(self.buf[:-32], self.iv)
 
-        block = AddRoundKey(block, round_key)
-        block = MixColumnsInv(block)
-        block = ShiftRowsInv(block)
-        block = SubBytesInv(block)
 
-    # Undo initial round
-    block = AddRoundKey(block, fullkey[:16])
+def encrypt_128_ctr_file(fin, fout, key):
+    stream_file(CTREncryptor(key, AES128), fin, fout)
 
-    return "".join([chr(b) for b in block])
 
+def decrypt_128_ctr_file(fin, fout, key):
+    stream_file(CTRDecryptor(key, AES128), fin, fout)
 
-class RNG_CTR(RngBase):
+
+def encrypt_256_ctr_file(fin, fout, key):
+    stream_file(CTREncryptor(key, AES256), fin, fout)
+
+
+def decrypt_256_ctr_file(fin, fout, key):
+    stream_file(CTRDecryptor(key, AES256), fin, fout)
+
+
+def encrypt_128_cbc_file(fin, fout, key):
+    stream_file(CBCEncryptor(key, AES128), fin, fout)
+
+
+def decrypt_128_cbc_file(fin, fout, key):
+    stream_file(CBCDecryptor(key, AES128), fin, fout)
+
+
+def encrypt_256_cbc_file(fin, fout, key):
+    stream_file(CBCEncryptor(key, AES256), fin, fout)
+
+
+def decrypt_256_cbc_file(fin, fout, key):
+    stream_file(CBCDecryptor(key, AES256), fin, fout)
+
+
+def decrypt_range(cls, data_or_file, key, start, end):
+    "Decrypt plaintext bytes start..end of a CTR ciphertext"
+    if start < 0 or start > end:
+        raise ValueError("Invalid range %i..%i" % (start, end))
+    end = min(end, data_length(data_or_file) - 48)
+    if start >= end:
+        return ""
+    # Jump straight to the counter of the first block we need
+    first = start // 16
+    counter = advance_counter(read_range(data_or_file, 0, 16), first)
+    ciphertext = read_range(data_or_file, 16 + first * 16, 16 + end)
+    return cls(key).ctr(ciphertext, counter)[start - first * 16:]
+
+
+# These do not check the HMAC, use verify_sha256_hmac for that. Both
+# work on a string or on a seekable file object and only read the
+# requested blocks.
+
+def decrypt_range_128_ctr(data_or_file, key, start, end):
+    return decrypt_range(AES128, data_or_file, key, start, end)
+
+
+def decrypt_range_256_ctr(data_or_file, key, start, end):
+    return decrypt_range(AES256, data_or_file, key, start, end)
+
+
+class RNG_CTR(BufferedRngBase):
 
     "A Random number generator based of AES-128-CTR"
 
     def __init__(self):
-        self.key = os.urandom(16)
+        BufferedRngBase.__init__(self)
+        self.aes = AES128(os.urandom(16))
         self.counter = os.urandom(16)
-        self.buf = ""
-
-    def update_buffer(self):
-        self.buf += aes128enc(self.counter, self.key)
-        self.counter = advance_counter(self.counter)
 
-    def rand_int8(self):
-        "return a psuedorandom integer mod 256"
-        if len(self.buf) < 1:
-            self.update_buffer()
-        r = ord(self.buf[0])
-        self.buf = self.buf[1:]
+    def keystream(self, nblocks):
+        r = self.aes.ctr("\0" * (16 * nblocks), self.counter)
+        self.counter = advance_counter(self.counter, nblocks)
         return r
 
 
 def cbc_mac(data, key):
-    key = fixed_length_key(key, 16)
-    data = pkcs7.add_padding(data, 16)
-    iv = "\0" * 16
-    r = ""
-    for i in range(0, len(data), 16):
-        cipherblock = aes128enc(xor_str(data[i:i + 16], iv), key)
-        r += cipherblock
-        iv = cipherblock
-    return iv
+    return AES128(key).cbc_mac(data)
+
+
+# Encrypt-then-MAC modes into a caller supplied buffer (bytearray), in
+# the same format as the one-shot functions. Both directions work
+# SEGMENT_SIZE bytes at a time, so peak memory is about one buffer.
+# Ciphertext needs len(data) + 48 bytes (CTR) or len(data) + 64 bytes
+# (CBC), plaintext at most len(data) - 48.
+
+def encrypt_128_ctr_into(out, data, key, offset=0):
+    return AES128(key).encrypt_ctr_hmac_into(out, data, offset)
+
+
+def decrypt_128_ctr_into(out, data, key, offset=0):
+    return AES128(key).decrypt_ctr_hmac_into(out, data, offset)
+
+
+def encrypt_256_ctr_into(out, data, key, offset=0):
+    return AES256(key).encrypt_ctr_hmac_into(out, data, offset)
+
+
+def decrypt_256_ctr_into(out, data, key, offset=0):
+    return AES256(key).decrypt_ctr_hmac_into(out, data, offset)
+
+
+def encrypt_128_cbc_into(out, data, key, offset=0):
+    return AES128(key).encrypt_cbc_hmac_into(out, data, offset)
+
+
+def decrypt_128_cbc_into(out, data, key, offset=0):
+    return AES128(key).decrypt_cbc_hmac_into(out, data, offset)
+
+
+def encrypt_256_cbc_into(out, data, key, offset=0):
+    return AES256(key).encrypt_cbc_hmac_into(out, data, offset)
+
+
+def decrypt_256_cbc_into(out, data, key, offset=0):
+    return AES256(key).decrypt_cbc_hmac_into(out, data, offset)
+
+
+encrypt_into = encrypt_256_ctr_into
+decrypt_into = decrypt_256_ctr_into
+
 
 # Defaults
 rand = RNG_CTR().rand
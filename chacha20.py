@@ -16,16 +16,61 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import crypturd
+import os
+import struct
+import ctypes
+import multiprocessing
+import threading
 from crypturd.common import rotl_i32, rotr_i32, _i32, null_padding
 from crypturd.common import int2littleendian, littleendian2int
-from crypturd.common import xor_str, modexp, RngBase, fixed_length_key
-from crypturd.poly1305 import add_poly1305_mac, check_poly1305_mac
+from crypturd.common import xor_str, modexp, BufferedRngBase, fixed_length_key
+from crypturd.common import data_length, read_range, stream_file
+from crypturd.poly1305 import add_poly1305_mac, check_poly1305_mac, poly1305
+from crypturd.poly1305 import Poly1305, poly1305_key_gen
 from crypturd.sha import sha256
 from os import urandom
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# NumPy is optional, it is only used to compute many blocks in one batch
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 # first 4 intial values of chacha block
 constants = [0x61707865, 0x3320646e, 0x79622d32, 0x6b206574]
 
+# Use NumPy for batches of at least this many blocks
+USE_NUMPY = numpy is not None
+NUMPY_MIN_BLOCKS = 48
+
+# Maximum number of blocks chacha20_rand generates at a time
+RAND_BUFFER_BLOCKS = 1024
+
+# With parallel=True, inputs of at least PARALLEL_THRESHOLD bytes are
+# encrypted by a pool of worker processes. Every worker computes the key
+# stream for its own range of counters and writes straight into a shared
+# output buffer. Starting the pool costs a fork per worker on every call,
+# so it is off by default.
+PARALLEL_THRESHOLD = 1 << 22
+PARALLEL_PROCESSES = None       # None uses one process per cpu
+PARALLEL_SEGMENT_SIZE = 1 << 20
+
+# Number of nonces a ChaCha20Poly1305Session reads from urandom at a time
+NONCE_BUFFER_SIZE = 256
+
+# Number of (nonce, poly1305 key, key stream) entries a
+# ChaCha20PrecomputedSession keeps ready, and the key stream blocks in each
+PRECOMPUTE_DEPTH = 64
+PRECOMPUTE_BLOCKS = 4
+
+# Plaintext bytes per chunk in the segmented format
+SEGMENT_CHUNK_SIZE = 1 << 16
+
 
 def quarter_round(X, a, b, c, d):
     "ChaCha quarter round, used as a subroutine of a the ChaCha cipher"
@@ -40,76 +85,681 @@ def quarter_round(X, a, b, c, d):
     X[b] = rotl_i32(X[b] ^ X[c], 7)
 
 
-def chacha20_block(key, counter, nonce):
-    "apply 20 rounds of ChaCha (10 vertical + 10 diagonal) to a block"
-    state = constants + key + counter + nonce
+def chacha20_block(key, counter, nonce, rounds=20):
+    "apply rounds of ChaCha (rounds/2 vertical + rounds/2 diagonal) to a block"
+    # The default 20 is ChaCha20, 8 and 12 give the reduced variants
+    # The 16 state words live in local variables and the quarter rounds
+    # are written out in full, see quarter_round for the readable version
+    j0, j1, j2, j3 = constants
+    j4, j5, j6, j7, j8, j9, j10, j11 = key
+    j12, j13, j14, j15 = counter + nonce
+    x0, x1, x2, x3, x4, x5, x6, x7 = j0, j1, j2, j3, j4, j5, j6, j7
+    x8, x9, x10, x11, x12, x13, x14, x15 = j8, j9, j10, j11, j12, j13, j14, j15
+
+    for i in range(rounds // 2):
+        # Columns
+        x0 = (x0 + x4) & 0xffffffff
+        x12 ^= x0
+        x12 = ((x12 << 16) & 0xffffffff) | (x12 >> 16)
+        x8 = (x8 + x12) & 0xffffffff
+        x4 ^= x8
+        x4 = ((x4 << 12) & 0xffffffff) | (x4 >> 20)
+        x0 = (x0 + x4) & 0xffffffff
+        x12 ^= x0
+        x12 = ((x12 << 8) & 0xffffffff) | (x12 >> 24)
+        x8 = (x8 + x12) & 0xffffffff
+        x4 ^= x8
+        x4 = ((x4 << 7) & 0xffffffff) | (x4 >> 25)
+        x1 = (x1 + x5) & 0xffffffff
+        x13 ^= x1
+        x13 = ((x13 << 16) & 0xffffffff) | (x13 >> 16)
+        x9 = (x9 + x13) & 0xffffffff
+        x5 ^= x9
+        x5 = ((x5 << 12) & 0xffffffff) | (x5 >> 20)
+        x1 = (x1 + x5) & 0xffffffff
+        x13 ^= x1
+        x13 = ((x13 << 8) & 0xffffffff) | (x13 >> 24)
+        x9 = (x9 + x13) & 0xffffffff
+        x5 ^= x9
+        x5 = ((x5 << 7) & 0xffffffff) | (x5 >> 25)
+        x2 = (x2 + x6) & 0xffffffff
+        x14 ^= x2
+        x14 = ((x14 << 16) & 0xffffffff) | (x14 >> 16)
+        x10 = (x10 + x14) & 0xffffffff
+        x6 ^= x10
+        x6 = ((x6 << 12) & 0xffffffff) | (x6 >> 20)
+        x2 = (x2 + x6) & 0xffffffff
+        x14 ^= x2
+        x14 = ((x14 << 8) & 0xffffffff) | (x14 >> 24)
+        x10 = (x10 + x14) & 0xffffffff
+        x6 ^= x10
+        x6 = ((x6 << 7) & 0xffffffff) | (x6 >> 25)
+        x3 = (x3 + x7) & 0xffffffff
+        x15 ^= x3
+        x15 = ((x15 << 16) & 0xffffffff) | (x15 >> 16)
+        x11 = (x11 + x15) & 0xffffffff
+        x7 ^= x11
+        x7 = ((x7 << 12) & 0xffffffff) | (x7 >> 20)
+        x3 = (x3 + x7) & 0xffffffff
+        x15 ^= x3
+        x15 = ((x15 << 8) & 0xffffffff) | (x15 >> 24)
+        x11 = (x11 + x15) & 0xffffffff
+        x7 ^= x11
+        x7 = ((x7 << 7) & 0xffffffff) | (x7 >> 25)
+        # Diagonals
+        x0 = (x0 + x5) & 0xffffffff
+        x15 ^= x0
+        x15 = ((x15 << 16) & 0xffffffff) | (x15 >> 16)
+        x10 = (x10 + x15) & 0xffffffff
+        x5 ^= x10
+        x5 = ((x5 << 12) & 0xffffffff) | (x5 >> 20)
+        x0 = (x0 + x5) & 0xffffffff
+        x15 ^= x0
+        x15 = ((x15 << 8) & 0xffffffff) | (x15 >> 24)
+        x10 = (x10 + x15) & 0xffffffff
+        x5 ^= x10
+        x5 = ((x5 << 7) & 0xffffffff) | (x5 >> 25)
+        x1 = (x1 + x6) & 0xffffffff
+        x12 ^= x1
+        x12 = ((x12 << 16) & 0xffffffff) | (x12 >> 16)
+        x11 = (x11 + x12) & 0xffffffff
+        x6 ^= x11
+        x6 = ((x6 << 12) & 0xffffffff) | (x6 >> 20)
+        x1 = (x1 + x6) & 0xffffffff
+        x12 ^= x1
+        x12 = ((x12 << 8) & 0xffffffff) | (x12 >> 24)
+        x11 = (x11 + x12) & 0xffffffff
+        x6 ^= x11
+        x6 = ((x6 << 7) & 0xffffffff) | (x6 >> 25)
+        x2 = (x2 + x7) & 0xffffffff
+        x13 ^= x2
+        x13 = ((x13 << 16) & 0xffffffff) | (x13 >> 16)
+        x8 = (x8 + x13) & 0xffffffff
+        x7 ^= x8
+        x7 = ((x7 << 12) & 0xffffffff) | (x7 >> 20)
+        x2 = (x2 + x7) & 0xffffffff
+        x13 ^= x2
+        x13 = ((x13 << 8) & 0xffffffff) | (x13 >> 24)
+        x8 = (x8 + x13) & 0xffffffff
+        x7 ^= x8
+        x7 = ((x7 << 7) & 0xffffffff) | (x7 >> 25)
+        x3 = (x3 + x4) & 0xffffffff
+        x14 ^= x3
+        x14 = ((x14 << 16) & 0xffffffff) | (x14 >> 16)
+        x9 = (x9 + x14) & 0xffffffff
+        x4 ^= x9
+        x4 = ((x4 << 12) & 0xffffffff) | (x4 >> 20)
+        x3 = (x3 + x4) & 0xffffffff
+        x14 ^= x3
+        x14 = ((x14 << 8) & 0xffffffff) | (x14 >> 24)
+        x9 = (x9 + x14) & 0xffffffff
+        x4 ^= x9
+        x4 = ((x4 << 7) & 0xffffffff) | (x4 >> 25)
 
-    # Make a copy of the initial state for later
-    state_init = [state[i] for i in range(16)]
+    # Mix in the original state to make it infeasable to invert this function
+    return struct.pack("<16I",
+                       (x0 + j0) & 0xffffffff, (x1 + j1) & 0xffffffff,
+                       (x2 + j2) & 0xffffffff, (x3 + j3) & 0xffffffff,
+                       (x4 + j4) & 0xffffffff, (x5 + j5) & 0xffffffff,
+                       (x6 + j6) & 0xffffffff, (x7 + j7) & 0xffffffff,
+                       (x8 + j8) & 0xffffffff, (x9 + j9) & 0xffffffff,
+                       (x10 + j10) & 0xffffffff, (x11 + j11) & 0xffffffff,
+                       (x12 + j12) & 0xffffffff, (x13 + j13) & 0xffffffff,
+                       (x14 + j14) & 0xffffffff, (x15 + j15) & 0xffffffff)
 
-    # We do 2 "full" rounds per inner loop
-    for i in range(10):
-        # Apply the quarter round routine to columns
-        quarter_round(state, 0, 4,  8, 12)
-        quarter_round(state, 1, 5,  9, 13)
-        quarter_round(state, 2, 6, 10, 14)
-        quarter_round(state, 3, 7, 11, 15)
 
-        # Apply the quarter round routine to diagonals
-        quarter_round(state, 0, 5, 10, 15)
-        quarter_round(state, 1, 6, 11, 12)
-        quarter_round(state, 2, 7,  8, 13)
-        quarter_round(state, 3, 4,  9, 14)
+def numpy_quarter_round(X, a, b, c, d):
+    "ChaCha quarter round on rows of 32-bit integers, one column per block"
+    X[a] += X[b]
+    X[d] ^= X[a]
+    X[d] = (X[d] << 16) | (X[d] >> 16)
+    X[c] += X[d]
+    X[b] ^= X[c]
+    X[b] = (X[b] << 12) | (X[b] >> 20)
+    X[a] += X[b]
+    X[d] ^= X[a]
+    X[d] = (X[d] << 8) | (X[d] >> 24)
+    X[c] += X[d]
+    X[b] ^= X[c]
+    X[b] = (X[b] << 7) | (X[b] >> 25)
+
+
+def numpy_chacha20_blocks(key_words, counter, nonce_words, nblocks, rounds=20):
+    "chacha20_block for nblocks consecutive counters at once"
+    state = numpy.empty((16, nblocks), dtype=numpy.uint32)
+    state[0:4] = numpy.array(constants, dtype=numpy.uint32)[:, None]
+    state[4:12] = numpy.array(key_words, dtype=numpy.uint32)[:, None]
+    state[12] = (counter + numpy.arange(nblocks, dtype=numpy.uint64)) & 0xffffffff
+    state[13:16] = numpy.array(nonce_words, dtype=numpy.uint32)[:, None]
+
+    # Every row holds the same word of all blocks, additions wrap mod 2**32
+    X = list(state.copy())
+    for i in range(rounds // 2):
+        numpy_quarter_round(X, 0, 4,  8, 12)
+        numpy_quarter_round(X, 1, 5,  9, 13)
+        numpy_quarter_round(X, 2, 6, 10, 14)
+        numpy_quarter_round(X, 3, 7, 11, 15)
+        numpy_quarter_round(X, 0, 5, 10, 15)
+        numpy_quarter_round(X, 1, 6, 11, 12)
+        numpy_quarter_round(X, 2, 7,  8, 13)
+        numpy_quarter_round(X, 3, 4,  9, 14)
+    state += numpy.array(X)
+    return state.T.astype("<u4").tobytes()
+
+
+def chacha20_keystream(key_words, counter, nonce_words, nblocks, rounds=20):
+    "Key stream of nblocks consecutive blocks, starting at counter"
+    if USE_NUMPY and numpy is not None and nblocks >= NUMPY_MIN_BLOCKS:
+        return numpy_chacha20_blocks(key_words, counter, nonce_words, nblocks, rounds)
+    return "".join([chacha20_block(key_words, [_i32(counter + j)], nonce_words, rounds)
+                    for j in range(nblocks)])
+
+
+worker_state = None
 
-    # Mix in the original state to make it infeasable to invert this function
-    for i in range(16):
-        state[i] = _i32(state[i] + state_init[i])
 
-    # Encode everythin as a string
-    return "".join([int2littleendian(state[i], 4) for i in range(16)])
+def init_chacha20_worker(key_words, nonce_words, data, out, rounds=20):
+    "Keep the key and the shared buffers around in every worker process"
+    global worker_state
+    worker_state = (key_words, nonce_words, data, out, rounds)
+
+
+def chacha20_worker(args):
+    start, end, counter = args
+    key_words, nonce_words, data, out, rounds = worker_state
+    key_stream = chacha20_keystream(key_words, _i32(counter), nonce_words,
+                                    (end - start + 63) // 64, rounds)
+    result = xor_str(data[start:end], key_stream)
+    ctypes.memmove(ctypes.addressof(out) + start, result, len(result))
+
+
+def parallel_chacha20(key_words, counter, nonce_words, data, processes=None,
+                      rounds=20):
+    "XOR data with the key stream, segments are computed in parallel"
+    if processes is None:
+        processes = PARALLEL_PROCESSES
+    segment_size = PARALLEL_SEGMENT_SIZE - PARALLEL_SEGMENT_SIZE % 64
+    # The buffers are created before the workers so they are inherited
+    # rather than pickled, only the segment bounds are sent to workers
+    shared_data = multiprocessing.RawArray("c", len(data))
+    shared_data.raw = data
+    out = multiprocessing.RawArray("c", len(data))
+    pool = multiprocessing.Pool(processes, init_chacha20_worker,
+                                (key_words, nonce_words, shared_data, out, rounds))
+    try:
+        pool.map(chacha20_worker,
+                 [(i, min(i + segment_size, len(data)), counter + i // 64)
+                  for i in range(0, len(data), segment_size)])
+    finally:
+        pool.close()
+        pool.join()
+    return out.raw
+
+
+def chacha20_xor(key_words, counter, nonce_words, data, rounds=20,
+                 parallel=False):
+    "XOR data with the key stream, in parallel for large inputs if asked to"
+    if parallel and len(data) >= PARALLEL_THRESHOLD:
+        return parallel_chacha20(key_words, counter, nonce_words, data, rounds=rounds)
+    key_stream = chacha20_keystream(key_words, counter, nonce_words,
+                                    (len(data) + 63) // 64, rounds)
+    return xor_str(data, key_stream)
 
 
 @add_poly1305_mac
-def chacha20_encrypt(plaintext, key, counter=1):
+def chacha20_encrypt(plaintext, key, counter=1, rounds=20, parallel=False):
     "Encrypt a string using a key"
     key = fixed_length_key(key, 32)
     key_words = [littleendian2int(key[i:i + 4]) for i in range(0, 32, 4)]
     nonce_words = [littleendian2int(urandom(4)) for _ in range(3)]
-    ciphertext = "".join([int2littleendian(n, 4) for n in nonce_words])
-
-    for i in range(0, len(plaintext), 64):
-        j = _i32(i // 64)
-        key_stream = chacha20_block(
-            key_words, [_i32(counter + j)], nonce_words)
-        block = plaintext[i:i + 64]
-        ciphertext += xor_str(block, key_stream)
-
-    return ciphertext
+    nonce = "".join([int2littleendian(n, 4) for n in nonce_words])
+    return nonce + chacha20_xor(key_words, counter, nonce_words, plaintext,
+                                rounds, parallel)
 
 
 @check_poly1305_mac
-def chacha20_decrypt(data, key, counter=1):
+def chacha20_decrypt(data, key, counter=1, rounds=20, parallel=False):
     "Decrypt a string using a key"
     key = fixed_length_key(key, 32)
     key_words = [littleendian2int(key[i:i + 4]) for i in range(0, 32, 4)]
     nonce_words = [littleendian2int(data[i:i + 4]) for i in range(0, 12, 4)]
-    ciphertext = data[12:]
-    plaintext = ""
-    for i in range(0, len(ciphertext), 64):
-        j = _i32(i // 64)
-        key_stream = chacha20_block(
-            key_words, [_i32(counter + j)], nonce_words)
-        block = ciphertext[i:i + 64]
-        plaintext += xor_str(block, key_stream)
+    return chacha20_xor(key_words, counter, nonce_words, data[12:], rounds,
+                        parallel)
+
+
+def chacha20_decrypt_range(data_or_file, key, start, end, counter=1, rounds=20):
+    "Decrypt bytes start..end of a ciphertext, without checking the MAC"
+    # Use verify_poly1305_mac to check the MAC separately
+    if start < 0 or start > end:
+        raise ValueError("Invalid range %i..%i" % (start, end))
+    key = fixed_length_key(key, 32)
+    end = min(end, data_length(data_or_file) - 28)
+    if start >= end:
+        return ""
+    key_words = [littleendian2int(key[i:i + 4]) for i in range(0, 32, 4)]
+    nonce = read_range(data_or_file, 0, 12)
+    nonce_words = [littleendian2int(nonce[i:i + 4]) for i in range(0, 12, 4)]
+    # Only generate the key stream for the blocks we need
+    first = start // 64
+    ciphertext = read_range(data_or_file, 12 + first * 64, 12 + end)
+    key_stream = chacha20_keystream(key_words, _i32(counter + first), nonce_words,
+                                    (end + 63) // 64 - first, rounds)
+    return xor_str(ciphertext, key_stream)[start - first * 64:]
+
+
+class ChaCha20Poly1305Session():
+
+    "chacha20_encrypt/chacha20_decrypt for many messages under one key"
+
+    def __init__(self, key):
+        key = fixed_length_key(key, 32)
+        self.key_words = list(struct.unpack("<8I", key))
+        self.nonces = ""
+        self.nonce_pos = 0
+        self.pid = None
+
+    def nonce(self):
+        "Return a fresh random nonce"
+        # A forked child must not hand out the nonces of its parent
+        if self.nonce_pos >= len(self.nonces) or self.pid != os.getpid():
+            self.nonces = urandom(12 * NONCE_BUFFER_SIZE)
+            self.nonce_pos = 0
+            self.pid = os.getpid()
+        nonce = self.nonces[self.nonce_pos:self.nonce_pos + 12]
+        self.nonce_pos += 12
+        return nonce
+
+    def key_stream(self, nonce, length):
+        "Poly1305 key (block 0) and key stream (blocks 1 and up) for a nonce"
+        blocks = chacha20_keystream(self.key_words, 0, list(struct.unpack("<3I", nonce)),
+                                    1 + (length + 63) // 64)
+        return blocks[:32], blocks[64:]
+
+    def seal(self, plaintext):
+        "Encrypt a string, same output format as chacha20_encrypt"
+        nonce = self.nonce()
+        otk, key_stream = self.key_stream(nonce, len(plaintext))
+        ciphertext = nonce + xor_str(plaintext, key_stream)
+        return ciphertext + poly1305(ciphertext, otk)
+
+    def open(self, data):
+        "Decrypt a string made by seal or chacha20_encrypt"
+        if len(data) < 28:
+            raise Exception("Invalid MAC (Poly1305)")
+        ciphertext = data[12:-16]
+        otk, key_stream = self.key_stream(data[:12], len(ciphertext))
+        if data[-16:] != poly1305(data[:-16], otk):
+            raise Exception("Invalid MAC (Poly1305)")
+        return xor_str(ciphertext, key_stream)
+
+
+class ChaCha20PrecomputedSession(ChaCha20Poly1305Session):
+
+    "ChaCha20Poly1305Session that computes key streams ahead in a thread"
+
+    # The thread holds the key until close() is called, so always call
+    # close() or use the session in a with statement
+
+    def __init__(self, key, depth=None, blocks=None):
+        ChaCha20Poly1305Session.__init__(self, key)
+        self.key = fixed_length_key(key, 32)
+        self.depth = PRECOMPUTE_DEPTH if depth is None else depth
+        self.blocks = PRECOMPUTE_BLOCKS if blocks is None else blocks
+        self.owner = None
+        self.start()
+
+    def start(self):
+        # Also called in a forked child, where the parent's thread may
+        # have held the lock at the time of the fork
+        self.owner = os.getpid()
+        self.stopped = False
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.entries = queue.Queue(self.depth)
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def nonce(self):
+        # Shared between the background thread and seal
+        with self.lock:
+            return ChaCha20Poly1305Session.nonce(self)
+
+    def entry(self, blocks):
+        "A fresh nonce with its poly1305 key and the first blocks of key stream"
+        nonce = self.nonce()
+        key_stream = chacha20_keystream(self.key_words, 1, list(struct.unpack("<3I", nonce)),
+                                        blocks)
+        return nonce, poly1305_key_gen(self.key, nonce), key_stream
+
+    def run(self):
+        while not self.stopped:
+            entry = self.entry(self.blocks)
+            while not self.stopped:
+                try:
+                    self.entries.put(entry, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+
+    def pool_depth(self):
+        "Number of precomputed entries ready to be used"
+        return self.entries.qsize()
+
+    def seal(self, plaintext):
+        "Encrypt a string, same output format as chacha20_encrypt"
+        # Entries made before a fork are dropped so no nonce is used twice
+        if self.owner != os.getpid():
+            self.start()
+        nblocks = (len(plaintext) + 63) // 64
+        try:
+            nonce, otk, key_stream = self.entries.get_nowait()
+        except queue.Empty:
+            nonce, otk, key_stream = self.entry(nblocks)
+            self.misses += 1
+        else:
+            if len(key_stream) < len(plaintext):
+                key_stream += chacha20_keystream(
+                    self.key_words, 1 + len(key_stream) // 64,
+                    list(struct.unpack("<3I", nonce)), nblocks - len(key_stream) // 64)
+                self.misses += 1
+            else:
+                self.hits += 1
+        ciphertext = nonce + xor_str(plaintext, key_stream)
+        return ciphertext + poly1305(ciphertext, otk)
+
+    def close(self):
+        "Stop the background thread and drop the precomputed key streams"
+        self.stopped = True
+        # After a fork the thread only exists in the parent
+        if self.owner == os.getpid():
+            self.thread.join()
+        while True:
+            try:
+                self.entries.get_nowait()
+            except queue.Empty:
+                break
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ChaCha20Stream():
+
+    "Key stream state shared by ChaCha20Encryptor and ChaCha20Decryptor"
+
+    def __init__(self, key, counter=1):
+        self.key = fixed_length_key(key, 32)
+        self.key_words = list(struct.unpack("<8I", self.key))
+        self.counter = counter
+        self.nonce_words = None
+        self.mac = None
+        self.buf = ""
+
+    def start(self, nonce):
+        self.nonce_words = list(struct.unpack("<3I", nonce))
+        self.mac = Poly1305(poly1305_key_gen(self.key, nonce))
+        self.mac.update(nonce)
+
+    def crypt(self, data):
+        "XOR data with the next len(data) bytes of key stream"
+        nblocks = (len(data) + 63) // 64
+        r = xor_str(data, chacha20_keystream(self.key_words, _i32(self.counter),
+                                             self.nonce_words, nblocks))
+        self.counter += nblocks
+        return r
+
+
+class ChaCha20Encryptor(ChaCha20Stream):
+
+    "Incremental chacha20_encrypt"
+
+    def __init__(self, key, counter=1):
+        ChaCha20Stream.__init__(self, key, counter)
+        self.header = urandom(12)
+        self.start(self.header)
+
+    def update(self, data):
+        data = self.buf + data
+        end = len(data) - len(data) % 64
+        ciphertext = self.crypt(data[:end])
+        self.mac.update(ciphertext)
+        self.buf = data[end:]
+        r = self.header + ciphertext
+        self.header = ""
+        return r
+
+    def finalize(self):
+        ciphertext = self.crypt(self.buf)
+        self.mac.update(ciphertext)
+        return self.header + ciphertext + self.mac.digest()
+
+
+class ChaCha20Decryptor(ChaCha20Stream):
 
-    return plaintext
+    "Incremental chacha20_decrypt, returns plaintext before the tag is checked"
 
+    # finalize() raises an exception if the Poly1305 tag is invalid, and
+    # everything returned by update() up to then must be discarded. Use
+    # ChaCha20SegmentedDecryptor to only release authenticated plaintext.
 
-class chacha20_rand(RngBase):
+    def update(self, data):
+        data = self.buf + data
+        if self.mac is None:
+            if len(data) < 12:
+                self.buf = data
+                return ""
+            self.start(data[:12])
+            data = data[12:]
+        # Hold back anything that could be part of the tag
+        end = max(len(data) - 16, 0)
+        end -= end % 64
+        self.mac.update(data[:end])
+        self.buf = data[end:]
+        return self.crypt(data[:end])
+
+    def finalize(self):
+        if self.mac is None or len(self.buf) < 16:
+            raise Exception("Invalid MAC (Poly1305)")
+        self.mac.update(self.buf[:-16])
+        if self.buf[-16:] != self.mac.digest():
+            raise Exception("Invalid MAC (Poly1305)")
+        return self.crypt(self.buf[:-16])
+
+
+def chacha20_encrypt_file(fin, fout, key):
+    stream_file(ChaCha20Encryptor(key), fin, fout)
+
+
+def chacha20_decrypt_file(fin, fout, key):
+    "Decrypt fin into fout, raises an exception if the tag is invalid"
+    # Plaintext is written to fout before the tag is checked, discard it
+    # if this raises. chacha20_segmented_decrypt_file only writes chunks
+    # that passed their tag.
+    stream_file(ChaCha20Decryptor(key), fin, fout)
+
+
+# Segmented format, STREAM construction on top of ChaCha20-Poly1305:
+#
+#   prefix(7) || chunk_0 || tag_0 || chunk_1 || tag_1 || ... || tag_n
+#
+# Chunk i is encrypted with nonce prefix || i (4 bytes, big-endian) ||
+# last (1 byte, 1 for the final chunk and 0 otherwise) and has its own
+# Poly1305 tag. All chunks but the last hold SEGMENT_CHUNK_SIZE bytes of
+# plaintext, the last one may be shorter (or empty). Chunks can be
+# checked independently, and dropping, reordering or truncating chunks
+# changes their nonce so their tag no longer matches.
+
+def segment_nonce(prefix, index, last):
+    if index >= 1 << 32:
+        raise Exception("Message too long")
+    return prefix + struct.pack(">IB", index, last)
+
+
+def seal_chunk(key_words, prefix, index, last, plaintext):
+    "Encrypt and authenticate one chunk of the segmented format"
+    nonce_words = list(struct.unpack("<3I", segment_nonce(prefix, index, last)))
+    blocks = chacha20_keystream(key_words, 0, nonce_words, 1 + (len(plaintext) + 63) // 64)
+    ciphertext = xor_str(plaintext, blocks[64:])
+    return ciphertext + poly1305(ciphertext, blocks[:32])
+
+
+def open_chunk(key_words, prefix, index, last, data):
+    "Check and decrypt one chunk of the segmented format"
+    nonce_words = list(struct.unpack("<3I", segment_nonce(prefix, index, last)))
+    ciphertext = data[:-16]
+    blocks = chacha20_keystream(key_words, 0, nonce_words, 1 + (len(ciphertext) + 63) // 64)
+    if len(data) < 16 or data[-16:] != poly1305(ciphertext, blocks[:32]):
+        raise Exception("Invalid MAC (Poly1305)")
+    return xor_str(ciphertext, blocks[64:])
+
+
+segment_worker_key_words = None
+
+
+def init_segment_worker(key_words):
+    global segment_worker_key_words
+    segment_worker_key_words = key_words
+
+
+def seal_chunk_worker(args):
+    return seal_chunk(segment_worker_key_words, *args)
+
+
+def open_chunk_worker(args):
+    return open_chunk(segment_worker_key_words, *args)
+
+
+def map_chunks(f, worker, key_words, jobs, size, parallel=False):
+    "Run f on every job, in a pool of workers if parallel and size is large"
+    if not parallel or size < PARALLEL_THRESHOLD:
+        # Stops at the first chunk that raises
+        return [f(key_words, *job) for job in jobs]
+    pool = multiprocessing.Pool(PARALLEL_PROCESSES, init_segment_worker, (key_words,))
+    try:
+        return pool.map(worker, jobs)
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def chacha20_segmented_encrypt(plaintext, key, parallel=False):
+    "Encrypt a string using a key, in independently authenticated chunks"
+    key = fixed_length_key(key, 32)
+    key_words = list(struct.unpack("<8I", key))
+    prefix = urandom(7)
+    chunks = [plaintext[i:i + SEGMENT_CHUNK_SIZE]
+              for i in range(0, len(plaintext), SEGMENT_CHUNK_SIZE)] or [""]
+    jobs = [(prefix, i, int(i == len(chunks) - 1), chunk)
+            for i, chunk in enumerate(chunks)]
+    return prefix + "".join(map_chunks(seal_chunk, seal_chunk_worker,
+                                       key_words, jobs, len(plaintext),
+                                       parallel))
+
+
+def chacha20_segmented_decrypt(data, key, parallel=False):
+    "Decrypt a string made by chacha20_segmented_encrypt"
+    key = fixed_length_key(key, 32)
+    key_words = list(struct.unpack("<8I", key))
+    if len(data) < 7 + 16:
+        raise Exception("Invalid MAC (Poly1305)")
+    prefix = data[:7]
+    size = SEGMENT_CHUNK_SIZE + 16
+    chunks = [data[i:i + size] for i in range(7, len(data), size)]
+    jobs = [(prefix, i, int(i == len(chunks) - 1), chunk)
+            for i, chunk in enumerate(chunks)]
+    return "".join(map_chunks(open_chunk, open_chunk_worker,
+                              key_words, jobs, len(data), parallel))
+
+
+class ChaCha20SegmentedEncryptor():
+
+    "Incremental chacha20_segmented_encrypt"
+
+    def __init__(self, key):
+        self.key_words = list(struct.unpack("<8I", fixed_length_key(key, 32)))
+        self.prefix = urandom(7)
+        self.header = self.prefix
+        self.index = 0
+        self.buf = ""
+
+    def update(self, data):
+        data = self.buf + data
+        r = [self.header]
+        self.header = ""
+        # A full chunk is only sealed once we know it is not the last one
+        i = 0
+        while len(data) - i > SEGMENT_CHUNK_SIZE:
+            r.append(seal_chunk(self.key_words, self.prefix, self.index, 0,
+                                data[i:i + SEGMENT_CHUNK_SIZE]))
+            self.index += 1
+            i += SEGMENT_CHUNK_SIZE
+        self.buf = data[i:]
+        return "".join(r)
+
+    def finalize(self):
+        return self.header + seal_chunk(self.key_words, self.prefix,
+                                        self.index, 1, self.buf)
+
+
+class ChaCha20SegmentedDecryptor():
+
+    "Incremental chacha20_segmented_decrypt, chunks are checked before release"
+
+    def __init__(self, key):
+        self.key_words = list(struct.unpack("<8I", fixed_length_key(key, 32)))
+        self.prefix = None
+        self.index = 0
+        self.buf = ""
+
+    def update(self, data):
+        data = self.buf + data
+        if self.prefix is None:
+            if len(data) < 7:
+                self.buf = data
+                return ""
+            self.prefix = data[:7]
+            data = data[7:]
+        size = SEGMENT_CHUNK_SIZE + 16
+        r = []
+        i = 0
+        while len(data) - i > size:
+            r.append(open_chunk(self.key_words, self.prefix, self.index, 0,
+                                data[i:i + size]))
+            self.index += 1
+            i += size
+        self.buf = data[i:]
+        return "".join(r)
+
+    def finalize(self):
+        if self.prefix is None:
+            raise Exception("Invalid MAC (Poly1305)")
+        return open_chunk(self.key_words, self.prefix, self.index, 1, self.buf)
+
+
+def chacha20_segmented_encrypt_file(fin, fout, key):
+    stream_file(ChaCha20SegmentedEncryptor(key), fin, fout)
+
+
+def chacha20_segmented_decrypt_file(fin, fout, key):
+    stream_file(ChaCha20SegmentedDecryptor(key), fin, fout)
+
+
+class chacha20_rand(BufferedRngBase):
 
     "A Random number generator based of Chacha20"
 
-    def __init__(self, seed=None):
+    block_size = 64
+    buffer_blocks = RAND_BUFFER_BLOCKS
+    int32_format = "<I"
+
+    def __init__(self, seed=None, rounds=20):
+        BufferedRngBase.__init__(self)
+        self.rounds = rounds
         if not seed:
             seed = urandom(56)
         elif len(seed) < 4 * 8 + 3 * 8:
@@ -120,21 +770,47 @@ class chacha20_rand(RngBase):
         self.nonce_words = [littleendian2int(seed[32 + i * 4:32 + i * 4 + 4])
                             for _ in range(3)]
         self.counter = 1
-        self.buf = ""
 
-    def update_buffer(self):
-        self.buf += chacha20_block(
-            self.key_words, [_i32(self.counter)], self.nonce_words)
-        self.counter += 1
-
-    def rand_int8(self):
-        "return a psuedorandom integer mod 256"
-        if len(self.buf) < 1:
-            self.update_buffer()
-        r = ord(self.buf[0])
-        self.buf = self.buf[1:]
+    def keystream(self, nblocks):
+        r = chacha20_keystream(self.key_words, _i32(self.counter),
+                               self.nonce_words, nblocks, self.rounds)
+        self.counter += nblocks
         return r
 
+# Reduced round variants, faster but with a smaller security margin. Only
+# use them where a weaker cipher is acceptable (simulations, test data).
+def chacha8_encrypt(plaintext, key):
+    return chacha20_encrypt(plaintext, key, rounds=8)
+
+
+def chacha8_decrypt(data, key):
+    return chacha20_decrypt(data, key, rounds=8)
+
+
+def chacha12_encrypt(plaintext, key):
+    return chacha20_encrypt(plaintext, key, rounds=12)
+
+
+def chacha12_decrypt(data, key):
+    return chacha20_decrypt(data, key, rounds=12)
+
+
+class chacha8_rand(chacha20_rand):
+
+    "A Random number generator based of Chacha8"
+
+    def __init__(self, seed=None):
+        chacha20_rand.__init__(self, seed, 8)
+
+
+class chacha12_rand(chacha20_rand):
+
+    "A Random number generator based of Chacha12"
+
+    def __init__(self, seed=None):
+        chacha20_rand.__init__(self, seed, 12)
+
+
 # Defaults
 rand = chacha20_rand().rand
 encrypt = chacha20_encrypt
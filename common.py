@@ -18,7 +18,10 @@
 import sys
 import time
 import os
+import struct
+import copy
 import crypturd
+from binascii import hexlify, unhexlify
 
 # If true, show exceptions
 DEBUG = False
@@ -28,7 +31,15 @@ minus1_i32 = 2**32 - 1
 
 def xor_str(s1, s2):
     "xor two strings of equal size"
-    return "".join([chr(ord(c1) ^ ord(c2)) for c1, c2 in zip(s1, s2)])
+    # Done as a single integer XOR, longer inputs are truncated like zip
+    n = min(len(s1), len(s2))
+    if n == 0:
+        return ""
+    if len(s1) > n:
+        s1 = s1[:n]
+    if len(s2) > n:
+        s2 = s2[:n]
+    return unhexlify("%0*x" % (2 * n, int(hexlify(s1), 16) ^ int(hexlify(s2), 16)))
 
 
 def null_padding(s, n):
@@ -102,6 +113,116 @@ class RngBase():
         return r
 
 
+class BufferedRngBase(RngBase):
+
+    "Base class for random number generators producing whole keystream blocks"
+
+    block_size = 16
+    # Maximum number of blocks generated per refill of the buffer
+    buffer_blocks = 4096
+    # struct format used to turn 4 bytes of keystream into an integer
+    int32_format = ">I"
+
+    def __init__(self, key=""):
+        self.buf = ""
+        self.pos = 0
+        self.refill_blocks = 1
+
+    def keystream(self, nblocks):
+        "return the next nblocks blocks of keystream"
+        return ""
+
+    def refill(self, i):
+        "Make sure at least i bytes are left in the buffer"
+        # Refills start small and double up to buffer_blocks, so short
+        # lived generators do not compute keystream they never use
+        left = len(self.buf) - self.pos
+        nblocks = max(self.refill_blocks,
+                      (i - left + self.block_size - 1) // self.block_size)
+        self.refill_blocks = min(2 * nblocks, self.buffer_blocks)
+        self.buf = self.buf[self.pos:] + self.keystream(nblocks)
+        self.pos = 0
+
+    def rand_int8(self):
+        "return a psuedorandom integer mod 256"
+        if self.pos >= len(self.buf):
+            self.refill(1)
+        r = ord(self.buf[self.pos])
+        self.pos += 1
+        return r
+
+    def rand_int32(self):
+        "return a psuedorandom integer mod 2**32"
+        return struct.unpack(self.int32_format, self.rand_bytes(4))[0]
+
+    def rand_bytes(self, i=1):
+        "Return a random sequence of bytes"
+        if self.pos + i > len(self.buf):
+            self.refill(i)
+        r = self.buf[self.pos:self.pos + i]
+        self.pos += i
+        return r
+
+    def fill(self, buffer):
+        "Overwrite a writable buffer (such as a bytearray) with random bytes"
+        buffer[0:len(buffer)] = self.rand_bytes(len(buffer))
+
+
+class HashBase():
+
+    "Base class for incremental hashes on 64-byte blocks, like hashlib"
+
+    block_size = 64
+    digest_size = 0
+    name = ""
+    # Initial chaining state
+    init = []
+
+    def __init__(self, m=""):
+        self.state = self.init
+        self.buf = ""
+        self.length = 0
+        self.update(m)
+
+    def compress(self, state, chunk):
+        "Return the chaining state after processing a 64-byte chunk"
+        return state
+
+    def padding(self, length):
+        "Padding appended to a message of length bytes"
+        return ""
+
+    def encode(self, state):
+        "Turn the final chaining state into the digest"
+        return ""
+
+    def update(self, m):
+        "Add more data to the message"
+        self.length += len(m)
+        m = self.buf + m
+        end = len(m) - len(m) % 64
+        state = self.state
+        for offset in range(0, end, 64):
+            state = self.compress(state, m[offset:offset + 64])
+        self.state = state
+        self.buf = m[end:]
+
+    def copy(self):
+        "A copy that can be updated independently, to share a common prefix"
+        return copy.copy(self)
+
+    def digest(self):
+        "Hash of all data so far, the object can still be updated after"
+        m = self.buf + self.padding(self.length)
+        state = self.state
+        for offset in range(0, len(m), 64):
+            state = self.compress(state, m[offset:offset + 64])
+        return self.encode(state)
+
+    def hexdigest(self):
+        return hexlify(self.digest())
+
+
 def SilenceErrors(f):
     "Replace any exception by a generic one"
     def SilentFuction(*args, **kwargs):
@@ -236,6 +357,36 @@ def littleendian2int(r):
     return n
 
 
+# Chunk size used when reading from file objects
+FILE_CHUNK_SIZE = 1 << 16
+
+
+def data_length(data_or_file):
+    "Length of a string or a seekable file object"
+    if hasattr(data_or_file, "seek"):
+        data_or_file.seek(0, 2)
+        return data_or_file.tell()
+    return len(data_or_file)
+
+
+def read_range(data_or_file, start, end):
+    "Bytes start..end of a string or a seekable file object"
+    if hasattr(data_or_file, "seek"):
+        data_or_file.seek(start)
+        return data_or_file.read(max(end - start, 0))
+    return data_or_file[start:end]
+
+
+def stream_file(stream, fin, fout):
+    "Pass a file through a stream object using constant memory"
+    while True:
+        chunk = fin.read(FILE_CHUNK_SIZE)
+        if not chunk:
+            break
+        fout.write(stream.update(chunk))
+    fout.write(stream.finalize())
+
+
 def is_hex(s):
     for c in s:
         if not (c in "0123456789abcdefABCDEF"):
@@ -503,7 +654,10 @@ class merkle_node():
         self.is_leaf = False
 
     def root_hash(self):
-        return crypturd.sha.sha256(self.left.root_hash() + self.left.root_hash())
+        data = self.left.root_hash() + self.left.root_hash()
+        if len(data) == 64:
+            return crypturd.sha.sha256_64(data)
+        return crypturd.sha.sha256(data)
 
     def nested_array(self):
         return [self.left.nested_array(), self.right.nested_array()]
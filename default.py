@@ -21,6 +21,16 @@ import crypturd
 # Default encryption is ChaCha20 (with poly1305 mac)
 encrypt = crypturd.chacha20.chacha20_encrypt
 decrypt = crypturd.chacha20.chacha20_decrypt
+# decrypt_file writes plaintext before the mac is checked, discard the
+# output if it raises. decrypt_segmented_file only writes checked chunks.
+encrypt_file = crypturd.chacha20.chacha20_encrypt_file
+decrypt_file = crypturd.chacha20.chacha20_decrypt_file
+
+# Segmented ChaCha20 (with a poly1305 mac per chunk)
+encrypt_segmented = crypturd.chacha20.chacha20_segmented_encrypt
+decrypt_segmented = crypturd.chacha20.chacha20_segmented_decrypt
+encrypt_segmented_file = crypturd.chacha20.chacha20_segmented_encrypt_file
+decrypt_segmented_file = crypturd.chacha20.chacha20_segmented_decrypt_file
 
 # Default hash is SHA56
 hash = crypturd.sha.sha256
@@ -64,8 +64,7 @@ class PrivateKey():
     def __init__(self, depth=3):
         self.depth = depth
         self.root_key = onetimesig.new_keys()
-        self.node_keys = [[onetimesig.new_keys()
-                           for ind in range(subtree_width)]
+        self.node_keys = [onetimesig.new_keys_many([None] * subtree_width)
                           for d in range(self.depth)]
         self.node_index = [0 for d in range(self.depth)]
 
@@ -109,12 +108,12 @@ class PrivateKey():
                     self.node_index[d] += 1
                     overflow = False
                     for d2 in range(d + 1, self.depth, 1):
-                        self.node_keys[d2] = [onetimesig.new_keys()
-                                              for ind in range(subtree_width)]
+                        self.node_keys[d2] = onetimesig.new_keys_many(
+                            [None] * subtree_width)
         if overflow:
             for d2 in range(0, self.depth, 1):
-                self.node_keys[d2] = [onetimesig.new_keys()
-                                      for ind in range(subtree_width)]
+                self.node_keys[d2] = onetimesig.new_keys_many(
+                    [None] * subtree_width)
         # for d in range(self.depth):
         #     ind = self.node_index[d]
         #     k = crypturd.common.hexstr(self.node_keys[d][ind][0])[:64]
@@ -16,7 +16,9 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from crypturd.common import rotl_i32 as rotl
-from crypturd.common import _i32,int2littleendian
+from crypturd.common import _i32
+from crypturd.common import HashBase
+import struct
 
 
 def md4_padding(L):
@@ -32,91 +34,100 @@ def md4_add_length_padding(m):
     return m + md4_padding(L)
 
 
+md4_init = [0x67452301, 0xefcdab89, 0x98badcfe, 0x10325476]
+
+
+def md4_compress(state, chunk):
+    "Apply the MD4 compression function to a single 64 byte chunk"
+    A, B, C, D = state
+    X = [0 for _ in range(16)]
+    for i in range(0, 16):
+        X[i] = ((ord(chunk[i * 4 + 0]) << 0) +
+                (ord(chunk[i * 4 + 1]) << 8) +
+                (ord(chunk[i * 4 + 2]) << 16) +
+                (ord(chunk[i * 4 + 3]) << 24))
+
+    AA = A
+    BB = B
+    CC = C
+    DD = D
+
+    A = round1(A, B, C, D, 0, 3, X)
+    D = round1(D, A, B, C, 1, 7, X)
+    C = round1(C, D, A, B, 2, 11, X)
+    B = round1(B, C, D, A, 3, 19, X)
+    A = round1(A, B, C, D, 4, 3, X)
+    D = round1(D, A, B, C, 5, 7, X)
+    C = round1(C, D, A, B, 6, 11, X)
+    B = round1(B, C, D, A, 7, 19, X)
+    A = round1(A, B, C, D, 8, 3, X)
+    D = round1(D, A, B, C, 9, 7, X)
+    C = round1(C, D, A, B, 10, 11, X)
+    B = round1(B, C, D, A, 11, 19, X)
+    A = round1(A, B, C, D, 12, 3, X)
+    D = round1(D, A, B, C, 13, 7, X)
+    C = round1(C, D, A, B, 14, 11, X)
+    B = round1(B, C, D, A, 15, 19, X)
+
+    A = round2(A, B, C, D, 0, 3, X)
+    D = round2(D, A, B, C, 4, 5, X)
+    C = round2(C, D, A, B, 8, 9, X)
+    B = round2(B, C, D, A, 12, 13, X)
+    A = round2(A, B, C, D, 1, 3, X)
+    D = round2(D, A, B, C, 5, 5, X)
+    C = round2(C, D, A, B, 9, 9, X)
+    B = round2(B, C, D, A, 13, 13, X)
+    A = round2(A, B, C, D, 2, 3, X)
+    D = round2(D, A, B, C, 6, 5, X)
+    C = round2(C, D, A, B, 10, 9, X)
+    B = round2(B, C, D, A, 14, 13, X)
+    A = round2(A, B, C, D, 3, 3, X)
+    D = round2(D, A, B, C, 7, 5, X)
+    C = round2(C, D, A, B, 11, 9, X)
+    B = round2(B, C, D, A, 15, 13, X)
+
+    A = round3(A, B, C, D, 0, 3, X)
+    D = round3(D, A, B, C, 8, 9, X)
+    C = round3(C, D, A, B, 4, 11, X)
+    B = round3(B, C, D, A, 12, 15, X)
+    A = round3(A, B, C, D, 2, 3, X)
+    D = round3(D, A, B, C, 10, 9, X)
+    C = round3(C, D, A, B, 6, 11, X)
+    B = round3(B, C, D, A, 14, 15, X)
+    A = round3(A, B, C, D, 1, 3, X)
+    D = round3(D, A, B, C, 9, 9, X)
+    C = round3(C, D, A, B, 5, 11, X)
+    B = round3(B, C, D, A, 13, 15, X)
+    A = round3(A, B, C, D, 3, 3, X)
+    D = round3(D, A, B, C, 11, 9, X)
+    C = round3(C, D, A, B, 7, 11, X)
+    B = round3(B, C, D, A, 15, 15, X)
+
+    A = _i32(A + AA)
+    B = _i32(B + BB)
+    C = _i32(C + CC)
+    D = _i32(D + DD)
+    return [A, B, C, D]
+
+
+class MD4(HashBase):
+
+    "Incremental MD4"
+
+    digest_size = 16
+    name = "md4"
+    init = md4_init
+    compress = staticmethod(md4_compress)
+    padding = staticmethod(md4_padding)
+
+    def encode(self, state):
+        # Produce the final hash value (little-endian):
+        return struct.pack("<4I", *state)
+
+
 def md4(m):
     "MD4 on a complete message"
-
-    A = 0x67452301
-    B = 0xefcdab89
-    C = 0x98badcfe
-    D = 0x10325476
-
-    m = md4_add_length_padding(m)
-
-    for offset in range(0, len(m), 64):
-        chunk = m[offset:offset + 64]
-        X = [0 for _ in range(16)]
-        for i in range(0, 16):
-            X[i] = ((ord(chunk[i * 4 + 0]) << 0) +
-                    (ord(chunk[i * 4 + 1]) << 8) +
-                    (ord(chunk[i * 4 + 2]) << 16) +
-                    (ord(chunk[i * 4 + 3]) << 24))
-
-        AA = A
-        BB = B
-        CC = C
-        DD = D
-
-        A = round1(A, B, C, D, 0, 3, X)
-        D = round1(D, A, B, C, 1, 7, X)
-        C = round1(C, D, A, B, 2, 11, X)
-        B = round1(B, C, D, A, 3, 19, X)
-        A = round1(A, B, C, D, 4, 3, X)
-        D = round1(D, A, B, C, 5, 7, X)
-        C = round1(C, D, A, B, 6, 11, X)
-        B = round1(B, C, D, A, 7, 19, X)
-        A = round1(A, B, C, D, 8, 3, X)
-        D = round1(D, A, B, C, 9, 7, X)
-        C = round1(C, D, A, B, 10, 11, X)
-        B = round1(B, C, D, A, 11, 19, X)
-        A = round1(A, B, C, D, 12, 3, X)
-        D = round1(D, A, B, C, 13, 7, X)
-        C = round1(C, D, A, B, 14, 11, X)
-        B = round1(B, C, D, A, 15, 19, X)
-
-        A = round2(A, B, C, D, 0, 3, X)
-        D = round2(D, A, B, C, 4, 5, X)
-        C = round2(C, D, A, B, 8, 9, X)
-        B = round2(B, C, D, A, 12, 13, X)
-        A = round2(A, B, C, D, 1, 3, X)
-        D = round2(D, A, B, C, 5, 5, X)
-        C = round2(C, D, A, B, 9, 9, X)
-        B = round2(B, C, D, A, 13, 13, X)
-        A = round2(A, B, C, D, 2, 3, X)
-        D = round2(D, A, B, C, 6, 5, X)
-        C = round2(C, D, A, B, 10, 9, X)
-        B = round2(B, C, D, A, 14, 13, X)
-        A = round2(A, B, C, D, 3, 3, X)
-        D = round2(D, A, B, C, 7, 5, X)
-        C = round2(C, D, A, B, 11, 9, X)
-        B = round2(B, C, D, A, 15, 13, X)
-
-        A = round3(A, B, C, D, 0, 3, X)
-        D = round3(D, A, B, C, 8, 9, X)
-        C = round3(C, D, A, B, 4, 11, X)
-        B = round3(B, C, D, A, 12, 15, X)
-        A = round3(A, B, C, D, 2, 3, X)
-        D = round3(D, A, B, C, 10, 9, X)
-        C = round3(C, D, A, B, 6, 11, X)
-        B = round3(B, C, D, A, 14, 15, X)
-        A = round3(A, B, C, D, 1, 3, X)
-        D = round3(D, A, B, C, 9, 9, X)
-        C = round3(C, D, A, B, 5, 11, X)
-        B = round3(B, C, D, A, 13, 15, X)
-        A = round3(A, B, C, D, 3, 3, X)
-        D = round3(D, A, B, C, 11, 9, X)
-        C = round3(C, D, A, B, 7, 11, X)
-        B = round3(B, C, D, A, 15, 15, X)
-
-        A = _i32(A + AA)
-        B = _i32(B + BB)
-        C = _i32(C + CC)
-        D = _i32(D + DD)
-
-    # Produce the final hash value (little-endian):
-    return (int2littleendian(A,4)+
-            int2littleendian(B,4)+
-            int2littleendian(C,4)+
-            int2littleendian(D,4))
+    return MD4(m).digest()
 
 
 # helper functions
@@ -16,7 +16,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import crypturd
-from crypturd.sha import sha256
+from crypturd.sha import sha256, sha256_chain, sha256_many, sha256_chain_many
 import os
 
 
@@ -43,23 +43,32 @@ def debug_use_key(msg,key):
 
 signature_size = 32*(32+2)           # signature size in bytes
 
-def hash_times(msg,n=1,h=sha256):
+def hash_times(msg,n=1,h=None):
+    if h is None:
+        return sha256_chain(msg,n)
     for _ in range(n):
         msg = h(msg)
     return msg
 
 def new_keys(sk = None):
     "Generate a public/private keypair for hash-based signatures"
-    if not sk or len(sk)<32*34:
-        sk = os.urandom(32*34)
-    pk = ""
-    # 32 secrets for 32 blocks of 8-bits each
-    for n in range(32):
-        pk+= hash_times(sk[n*32:n*32+32],256)
-    # 2 checksum blocks
-    pk += hash_times(sk[-64:-32],32)
-    pk += hash_times(sk[-32:],256)
-    return sha256(pk), sk
+    return new_keys_many([sk])[0]
+
+def new_keys_many(sks):
+    "Generate a keypair for every secret key in a list, hashing all chains together"
+    sks = [sk if sk and len(sk)>=32*34 else os.urandom(32*34) for sk in sks]
+    chains = []
+    steps = []
+    for sk in sks:
+        # 32 secrets for 32 blocks of 8-bits each
+        chains += [sk[n*32:n*32+32] for n in range(32)]
+        steps += [256]*32
+        # 2 checksum blocks
+        chains += [sk[-64:-32],sk[-32:]]
+        steps += [32,256]
+    ends = sha256_chain_many(chains,steps)
+    pks = sha256_many(["".join(ends[i*34:i*34+34]) for i in range(len(sks))])
+    return list(zip(pks,sks))
 
 def sign(msg, sk):
     "Sign a 256-bit value"
@@ -16,63 +16,142 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import crypturd
+import struct
 from crypturd.common import fixed_length_key,littleendian2int,int2littleendian
+from crypturd.common import data_length, read_range, FILE_CHUNK_SIZE
 
 def clamp(r):
     "Helper function for poly1305"
     return r & 0x0ffffffc0ffffffc0ffffffc0fffffff
 
 
+# Poly1305 works modulo p = 2**130 - 5. Since 2**130 = 5 (mod p) the
+# bits above 130 can be folded back in by multiplying them by 5.
+P1305 = (1 << 130) - 5
+MASK130 = (1 << 130) - 1
+ONEBIT128 = 1 << 128
+
+# Number of blocks combined per reduction, using precomputed powers of r
+FOLD_BLOCKS = 8
+
+
+def poly1305_powers(r, k=FOLD_BLOCKS):
+    "[r**k, ..., r**2, r] modulo p"
+    return [pow(r, k - j, P1305) for j in range(k)]
+
+
+def poly1305_blocks(r, accumulator, data, powers=None):
+    "Absorb data into the accumulator, only the last block may be partial"
+    # The accumulator is only partially reduced (below 2**131), reduce it
+    # mod P1305 before using it as a tag.
+    k = FOLD_BLOCKS if powers is None else len(powers)
+    end = len(data) - len(data) % (16 * k)
+    if end and powers is None:
+        powers = poly1305_powers(r, k)
+    chunk_size = 1024 * 16 * k
+
+    # k blocks at a time: (acc + m1)*r**k + m2*r**(k-1) + ... + mk*r
+    for base in range(0, end, chunk_size):
+        words = struct.unpack("<%dQ" % (min(chunk_size, end - base) // 8),
+                              data[base:min(base + chunk_size, end)])
+        for i in range(0, len(words), 2 * k):
+            x = (accumulator + (words[i] | (words[i + 1] << 64) | ONEBIT128)) * powers[0]
+            for j in range(1, k):
+                x += (words[i + 2 * j] | (words[i + 2 * j + 1] << 64) | ONEBIT128) * powers[j]
+            x = (x & MASK130) + 5 * (x >> 130)
+            accumulator = (x & MASK130) + 5 * (x >> 130)
+
+    # Then the remaining blocks one by one
+    for i in range(end, len(data), 16):
+        block = data[i:i + 16]
+        if len(block) == 16:
+            lo, hi = struct.unpack("<QQ", block)
+            n = lo | (hi << 64) | ONEBIT128
+        else:
+            lo, hi = struct.unpack("<QQ", block + "\x01" + "\0" * (15 - len(block)))
+            n = lo | (hi << 64)
+        x = (accumulator + n) * r
+        x = (x & MASK130) + 5 * (x >> 130)
+        accumulator = (x & MASK130) + 5 * (x >> 130)
+    return accumulator
+
+
 def poly1305(data, key):
     "Poly1305 message authentication code"
     r = littleendian2int(key[:16])
     r = clamp(r)
     s = littleendian2int(key[16:])
-    accumulator = 0
-    p = (1 << 130) - 5
-
-    for i in range(0, len(data), 16):
-        block = data[i:i + 16]
-        n = littleendian2int(block)
-        onebit = 2**(len(block) * 8)
-        n = n + onebit
-        accumulator += n
-        accumulator = (r * accumulator) % p
+    accumulator = poly1305_blocks(r, 0, data) % P1305
 
     accumulator += s
     tag = int2littleendian(accumulator, 16)[:16]
     return tag
 
 
-def poly1305_key_gen(key, nonce):
+class Poly1305():
+
+    "Incremental poly1305, feed data with update and get the tag with digest"
+
+    def __init__(self, key):
+        self.r = clamp(littleendian2int(key[:16]))
+        self.s = littleendian2int(key[16:])
+        self.powers = poly1305_powers(self.r)
+        self.accumulator = 0
+        self.buf = ""
+
+    def update(self, data):
+        data = self.buf + data
+        end = len(data) - len(data) % 16
+        self.accumulator = poly1305_blocks(self.r, self.accumulator,
+                                           data[:end], self.powers)
+        self.buf = data[end:]
+
+    def digest(self):
+        accumulator = poly1305_blocks(self.r, self.accumulator, self.buf, self.powers)
+        return int2littleendian(accumulator % P1305 + self.s, 16)[:16]
+
+
+def poly1305_key_gen(key, nonce, rounds=20):
     counter = 0
     key_words = [littleendian2int(key[i:i + 4]) for i in range(0, 32, 4)]
     nonce_words = [littleendian2int(nonce[i:i + 4]) for i in range(0, 12, 4)]
-    block = crypturd.chacha20_block(key_words, [counter], nonce_words)
+    block = crypturd.chacha20_block(key_words, [counter], nonce_words, rounds)
     return block[:32]
 
 
 def add_poly1305_mac(encf):
-    def f(data, key):
+    def f(data, key, counter=1, rounds=20, parallel=False):
         key = fixed_length_key(key, 32)
-        ciphertext = encf(data, key)
+        ciphertext = encf(data, key, counter, rounds, parallel)
         nonce = ciphertext[:12]
-        otk = poly1305_key_gen(key, nonce)
+        otk = poly1305_key_gen(key, nonce, rounds)
         tag = poly1305(ciphertext, otk)
         return ciphertext + tag
     return f
 
 
 def check_poly1305_mac(decf):
-    def f(data, key):
+    def f(data, key, counter=1, rounds=20, parallel=False):
         key = fixed_length_key(key, 32)
         ciphertext = data[:-16]
         nonce = ciphertext[:12]
-        otk = poly1305_key_gen(key, nonce)
+        otk = poly1305_key_gen(key, nonce, rounds)
 
         tag = data[-16:]
         if tag != poly1305(ciphertext, otk):
             raise Exception("Invalid MAC (Poly1305)")
-        plaintext = decf(ciphertext, key)
+        plaintext = decf(ciphertext, key, counter, rounds, parallel)
         return plaintext
     return f
+
+
+def verify_poly1305_mac(data_or_file, key):
+    "Check the tag at the end of a string or file without decrypting it"
+    key = fixed_length_key(key, 32)
+    length = data_length(data_or_file) - 16
+    if length < 12:
+        return False
+    mac = Poly1305(poly1305_key_gen(key, read_range(data_or_file, 0, 12)))
+    for i in range(0, length, FILE_CHUNK_SIZE):
+        mac.update(read_range(data_or_file, i, min(i + FILE_CHUNK_SIZE, length)))
+    return read_range(data_or_file, length, length + 16) == mac.digest()
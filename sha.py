@@ -16,14 +16,19 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
-from crypturd.common import rotr_i32 as rotr
-from crypturd.common import rotl_i32 as rotl
-from crypturd.common import _i32
-from crypturd.common import shiftr_i32 as shiftr
 from crypturd.common import xor_str
 from crypturd.common import null_padding
-from crypturd.common import int2bigendian
-from crypturd.common import int2littleendian
+from crypturd.common import data_length, read_range, FILE_CHUNK_SIZE
+from crypturd.common import HashBase
+from crypturd.md4 import MD4
+import struct
+import copy
+
+# NumPy is optional, it is only used to hash many messages in lanes
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 def SHA_padding(L):
@@ -39,102 +44,303 @@ def sha_add_length_padding(m):
     return m + SHA_padding(L)
 
 
+sha256_init = [0x6a09e667, 0xbb67ae85, 0x3c6ef372, 0xa54ff53a,
+               0x510e527f, 0x9b05688c, 0x1f83d9ab, 0x5be0cd19]
+
+
+SHA256_K = [0x428a2f98, 0x71374491, 0xb5c0fbcf, 0xe9b5dba5, 0x3956c25b, 0x59f111f1, 0x923f82a4, 0xab1c5ed5,
+            0xd807aa98, 0x12835b01, 0x243185be, 0x550c7dc3, 0x72be5d74, 0x80deb1fe, 0x9bdc06a7, 0xc19bf174,
+            0xe49b69c1, 0xefbe4786, 0x0fc19dc6, 0x240ca1cc, 0x2de92c6f, 0x4a7484aa, 0x5cb0a9dc, 0x76f988da,
+            0x983e5152, 0xa831c66d, 0xb00327c8, 0xbf597fc7, 0xc6e00bf3, 0xd5a79147, 0x06ca6351, 0x14292967,
+            0x27b70a85, 0x2e1b2138, 0x4d2c6dfc, 0x53380d13, 0x650a7354, 0x766a0abb, 0x81c2c92e, 0x92722c85,
+            0xa2bfe8a1, 0xa81a664b, 0xc24b8b70, 0xc76c51a3, 0xd192e819, 0xd6990624, 0xf40e3585, 0x106aa070,
+            0x19a4c116, 0x1e376c08, 0x2748774c, 0x34b0bcb5, 0x391c0cb3, 0x4ed8aa4a, 0x5b9cca4f, 0x682e6ff3,
+            0x748f82ee, 0x78a5636f, 0x84c87814, 0x8cc70208, 0x90befffa, 0xa4506ceb, 0xbef9a3f7, 0xc67178f2]
+
+
+def sha256_compress(state, chunk):
+    "Apply the SHA256 compression function to a single 64 byte chunk"
+    return sha256_rounds(state, sha256_schedule(list(struct.unpack(">16I", chunk))))
+
+
+class SHA256(HashBase):
+
+    "Incremental Sha256, for messages that arrive in pieces"
+
+    digest_size = 32
+    name = "sha256"
+    init = sha256_init
+    compress = staticmethod(sha256_compress)
+    padding = staticmethod(SHA_padding)
+
+    def encode(self, state):
+        return struct.pack(">8I", *state)
+
+
 def sha256(m):
     "Sha256 on a complete message"
-
-    h0 = 0x6a09e667
-    h1 = 0xbb67ae85
-    h2 = 0x3c6ef372
-    h3 = 0xa54ff53a
-    h4 = 0x510e527f
-    h5 = 0x9b05688c
-    h6 = 0x1f83d9ab
-    h7 = 0x5be0cd19
-
-    k = [
-        0x428a2f98, 0x71374491, 0xb5c0fbcf, 0xe9b5dba5, 0x3956c25b, 0x59f111f1, 0x923f82a4, 0xab1c5ed5,
-         0xd807aa98, 0x12835b01, 0x243185be, 0x550c7dc3, 0x72be5d74, 0x80deb1fe, 0x9bdc06a7, 0xc19bf174,
-         0xe49b69c1, 0xefbe4786, 0x0fc19dc6, 0x240ca1cc, 0x2de92c6f, 0x4a7484aa, 0x5cb0a9dc, 0x76f988da,
-         0x983e5152, 0xa831c66d, 0xb00327c8, 0xbf597fc7, 0xc6e00bf3, 0xd5a79147, 0x06ca6351, 0x14292967,
-         0x27b70a85, 0x2e1b2138, 0x4d2c6dfc, 0x53380d13, 0x650a7354, 0x766a0abb, 0x81c2c92e, 0x92722c85,
-         0xa2bfe8a1, 0xa81a664b, 0xc24b8b70, 0xc76c51a3, 0xd192e819, 0xd6990624, 0xf40e3585, 0x106aa070,
-         0x19a4c116, 0x1e376c08, 0x2748774c, 0x34b0bcb5, 0x391c0cb3, 0x4ed8aa4a, 0x5b9cca4f, 0x682e6ff3,
-         0x748f82ee, 0x78a5636f, 0x84c87814, 0x8cc70208, 0x90befffa, 0xa4506ceb, 0xbef9a3f7, 0xc67178f2]
-
-    # padd to blocks of 64 bytes
-    m = sha_add_length_padding(m)
-
-    for offset in range(0, len(m), 64):
-        chunk = m[offset:offset + 64]
-        w = [0 for _ in range(64)]
-        for i in range(0, 16):
-            w[i] = ((ord(chunk[i * 4 + 0]) << 24) +
-                    (ord(chunk[i * 4 + 1]) << 16) +
-                    (ord(chunk[i * 4 + 2]) << 8) +
-                    (ord(chunk[i * 4 + 3]) << 0))
-
-        for i in range(16, 64):
-            s0 = rotr(w[i - 15], 7) ^ rotr(
-                w[i - 15], 18) ^ shiftr(w[i - 15], 3)
-            s1 = rotr(w[i - 2], 17) ^ rotr(w[i - 2], 19) ^ shiftr(w[i - 2], 10)
-            w[i] = _i32(w[i - 16] + s0 + w[i - 7] + s1)
-
-        # Initialize working variables to current hash value:
-        a = h0
-        b = h1
-        c = h2
-        d = h3
-        e = h4
-        f = h5
-        g = h6
-        h = h7
-
-        # Compression function main loop:
-        for i in range(0, 64):
-            S1 = rotr(e, 6) ^ rotr(e, 11) ^ rotr(e, 25)
-            ch = (e & f) ^ ((~e) & g)
-            temp1 = h + S1 + ch + k[i] + w[i]
-            S0 = rotr(a, 2) ^ rotr(a, 13) ^ rotr(a, 22)
-            maj = (a & b) ^ (a & c) ^ (b & c)
-            temp2 = S0 + maj
-
-            h = g
-            g = f
-            f = e
-            e = _i32(d + temp1)
-            d = c
-            c = b
-            b = a
-            a = _i32(temp1 + temp2)
-
-        # Add the compressed chunk to the current hash value:
-        h0 = h0 + a
-        h1 = h1 + b
-        h2 = h2 + c
-        h3 = h3 + d
-        h4 = h4 + e
-        h5 = h5 + f
-        h6 = h6 + g
-        h7 = h7 + h
-
-    # Produce the final hash value (big-endian):
-    return (int2bigendian(h0,4)+
-            int2bigendian(h1,4)+
-            int2bigendian(h2,4)+
-            int2bigendian(h3,4)+
-            int2bigendian(h4,4)+
-            int2bigendian(h5,4)+
-            int2bigendian(h6,4)+
-            int2bigendian(h7,4))
+    return SHA256(m).digest()
+
+
+def sha256_schedule(w):
+    "Extend 16 message words to the full 64 word schedule, in place"
+    for i in range(16, 64):
+        x = w[i - 15]
+        y = w[i - 2]
+        w.append((w[i - 16] + w[i - 7] +
+                  (((x >> 7) | (x << 25)) ^ ((x >> 18) | (x << 14)) ^ (x >> 3)) +
+                  (((y >> 17) | (y << 15)) ^ ((y >> 19) | (y << 13)) ^ (y >> 10)))
+                 & 0xffffffff)
+    return w
+
+
+def sha256_rounds(state, w):
+    "The 64 SHA256 rounds over an expanded schedule, eight per loop pass"
+    K = SHA256_K
+    a, b, c, d, e, f, g, h = state
+    for i in range(0, 64, 8):
+        t = (h + K[i] + w[i] + (g ^ (e & (f ^ g))) +
+             (((e >> 6) | (e << 26)) ^ ((e >> 11) | (e << 21)) ^ ((e >> 25) | (e << 7))))
+        d = (d + t) & 0xffffffff
+        h = (t + (((a >> 2) | (a << 30)) ^ ((a >> 13) | (a << 19)) ^ ((a >> 22) | (a << 10))) +
+             ((a & b) | (c & (a | b)))) & 0xffffffff
+        t = (g + K[i + 1] + w[i + 1] + (f ^ (d & (e ^ f))) +
+             (((d >> 6) | (d << 26)) ^ ((d >> 11) | (d << 21)) ^ ((d >> 25) | (d << 7))))
+        c = (c + t) & 0xffffffff
+        g = (t + (((h >> 2) | (h << 30)) ^ ((h >> 13) | (h << 19)) ^ ((h >> 22) | (h << 10))) +
+             ((h & a) | (b & (h | a)))) & 0xffffffff
+        t = (f + K[i + 2] + w[i + 2] + (e ^ (c & (d ^ e))) +
+             (((c >> 6) | (c << 26)) ^ ((c >> 11) | (c << 21)) ^ ((c >> 25) | (c << 7))))
+        b = (b + t) & 0xffffffff
+        f = (t + (((g >> 2) | (g << 30)) ^ ((g >> 13) | (g << 19)) ^ ((g >> 22) | (g << 10))) +
+             ((g & h) | (a & (g | h)))) & 0xffffffff
+        t = (e + K[i + 3] + w[i + 3] + (d ^ (b & (c ^ d))) +
+             (((b >> 6) | (b << 26)) ^ ((b >> 11) | (b << 21)) ^ ((b >> 25) | (b << 7))))
+        a = (a + t) & 0xffffffff
+        e = (t + (((f >> 2) | (f << 30)) ^ ((f >> 13) | (f << 19)) ^ ((f >> 22) | (f << 10))) +
+             ((f & g) | (h & (f | g)))) & 0xffffffff
+        t = (d + K[i + 4] + w[i + 4] + (c ^ (a & (b ^ c))) +
+             (((a >> 6) | (a << 26)) ^ ((a >> 11) | (a << 21)) ^ ((a >> 25) | (a << 7))))
+        h = (h + t) & 0xffffffff
+        d = (t + (((e >> 2) | (e << 30)) ^ ((e >> 13) | (e << 19)) ^ ((e >> 22) | (e << 10))) +
+             ((e & f) | (g & (e | f)))) & 0xffffffff
+        t = (c + K[i + 5] + w[i + 5] + (b ^ (h & (a ^ b))) +
+             (((h >> 6) | (h << 26)) ^ ((h >> 11) | (h << 21)) ^ ((h >> 25) | (h << 7))))
+        g = (g + t) & 0xffffffff
+        c = (t + (((d >> 2) | (d << 30)) ^ ((d >> 13) | (d << 19)) ^ ((d >> 22) | (d << 10))) +
+             ((d & e) | (f & (d | e)))) & 0xffffffff
+        t = (b + K[i + 6] + w[i + 6] + (a ^ (g & (h ^ a))) +
+             (((g >> 6) | (g << 26)) ^ ((g >> 11) | (g << 21)) ^ ((g >> 25) | (g << 7))))
+        f = (f + t) & 0xffffffff
+        b = (t + (((c >> 2) | (c << 30)) ^ ((c >> 13) | (c << 19)) ^ ((c >> 22) | (c << 10))) +
+             ((c & d) | (e & (c | d)))) & 0xffffffff
+        t = (a + K[i + 7] + w[i + 7] + (h ^ (f & (g ^ h))) +
+             (((f >> 6) | (f << 26)) ^ ((f >> 11) | (f << 21)) ^ ((f >> 25) | (f << 7))))
+        e = (e + t) & 0xffffffff
+        a = (t + (((b >> 2) | (b << 30)) ^ ((b >> 13) | (b << 19)) ^ ((b >> 22) | (b << 10))) +
+             ((b & c) | (d & (b | c)))) & 0xffffffff
+    return [(x + y) & 0xffffffff for x, y in zip(state, [a, b, c, d, e, f, g, h])]
+
+
+# Padding words of a 32 byte message, which fits a single block
+SHA256_32_PADDING = [0x80000000, 0, 0, 0, 0, 0, 0, 256]
+
+# A 64 byte message is followed by a block of padding only, so its
+# schedule never changes
+SHA256_64_PADDING = sha256_schedule([0x80000000] + [0] * 14 + [512])
+
+
+def sha256_chain_words(words, n):
+    "Apply sha256 n times to a 32 byte value given as 8 integers"
+    for _ in range(n):
+        words = sha256_rounds(sha256_init, sha256_schedule(words + SHA256_32_PADDING))
+    return words
+
+
+def sha256_32(x):
+    "Sha256 of exactly 32 bytes, in a single compression"
+    if len(x) != 32:
+        raise Exception("sha256_32 expects 32 bytes, got %i" % len(x))
+    return struct.pack(">8I", *sha256_chain_words(list(struct.unpack(">8I", x)), 1))
+
+
+def sha256_chain(x, n):
+    "Apply sha256 n times, keeping the state as integers in between"
+    if n <= 0:
+        return x
+    if len(x) != 32:
+        x = sha256(x)
+        n -= 1
+    return struct.pack(">8I", *sha256_chain_words(list(struct.unpack(">8I", x)), n))
+
+
+def sha256_64(x):
+    "Sha256 of exactly 64 bytes, such as two concatenated digests"
+    if len(x) != 64:
+        raise Exception("sha256_64 expects 64 bytes, got %i" % len(x))
+    state = sha256_rounds(sha256_init, sha256_schedule(list(struct.unpack(">16I", x))))
+    return struct.pack(">8I", *sha256_rounds(state, SHA256_64_PADDING))
+
+
+# Use NumPy lanes for batches of at least this many messages
+USE_NUMPY = numpy is not None
+NUMPY_MIN_LANES = 64
+
+
+def numpy_sha256_rounds(state, w):
+    "sha256_rounds on rows of 32-bit integers, one column per message"
+    w = list(w)
+    for i in range(16, 64):
+        x = w[i - 15]
+        y = w[i - 2]
+        w.append(w[i - 16] + w[i - 7] +
+                 (((x >> 7) | (x << 25)) ^ ((x >> 18) | (x << 14)) ^ (x >> 3)) +
+                 (((y >> 17) | (y << 15)) ^ ((y >> 19) | (y << 13)) ^ (y >> 10)))
+    a, b, c, d, e, f, g, h = state
+    for k, x in zip(SHA256_K, w):
+        t1 = (h + x + numpy.uint32(k) + ((e & f) ^ (~e & g)) +
+              (((e >> 6) | (e << 26)) ^ ((e >> 11) | (e << 21)) ^ ((e >> 25) | (e << 7))))
+        t2 = ((((a >> 2) | (a << 30)) ^ ((a >> 13) | (a << 19)) ^ ((a >> 22) | (a << 10))) +
+              ((a & b) ^ (a & c) ^ (b & c)))
+        h = g
+        g = f
+        f = e
+        e = d + t1
+        d = c
+        c = b
+        b = a
+        a = t1 + t2
+    return [x + y for x, y in zip(state, [a, b, c, d, e, f, g, h])]
+
+
+def numpy_lanes(words, n):
+    "Rows of n identical 32-bit words"
+    return [numpy.full(n, x, dtype=numpy.uint32) for x in words]
+
+
+def numpy_sha256_many(messages):
+    "sha256 of many messages of one length, all blocks hashed in lanes"
+    n = len(messages)
+    padding = SHA_padding(len(messages[0]))
+    data = "".join([m + padding for m in messages])
+    blocks = numpy.frombuffer(data, dtype=">u4").reshape(n, -1).T.astype(numpy.uint32)
+    state = numpy_lanes(sha256_init, n)
+    for i in range(0, len(blocks), 16):
+        state = numpy_sha256_rounds(state, blocks[i:i + 16])
+    return numpy_digests(numpy.array(state))
+
+
+def numpy_digests(state):
+    "Split rows of state words into one digest per column"
+    data = state.T.astype(">u4").tobytes()
+    return [data[i:i + 32] for i in range(0, len(data), 32)]
+
+
+def sha256_many(messages):
+    "sha256 of every message in a list, the messages must have equal lengths"
+    if not messages:
+        return []
+    if len(set([len(m) for m in messages])) != 1:
+        raise Exception("sha256_many expects messages of equal length")
+    if USE_NUMPY and numpy is not None and len(messages) >= NUMPY_MIN_LANES:
+        return numpy_sha256_many(messages)
+    if len(messages[0]) == 32:
+        return [sha256_32(m) for m in messages]
+    return [sha256(m) for m in messages]
+
+
+def numpy_sha256_chain_many(values, steps):
+    "sha256_chain over lanes, lanes with fewer steps drop out early"
+    n = len(values)
+    order = sorted(range(n), key=lambda i: -steps[i])
+    words = numpy.frombuffer("".join([values[i] for i in order]),
+                             dtype=">u4").reshape(n, 8).T.astype(numpy.uint32)
+    padding = numpy_lanes(SHA256_32_PADDING, n)
+    init = numpy_lanes(sha256_init, n)
+    # Lanes sorted by descending steps, so the active lanes are a prefix
+    remaining = sorted(steps, reverse=True)
+    active = n
+    for step in range(remaining[0]):
+        while remaining[active - 1] <= step:
+            active -= 1
+        words[:, :active] = numpy_sha256_rounds(
+            [x[:active] for x in init],
+            list(words[:, :active]) + [x[:active] for x in padding])
+    result = [None] * n
+    for i, digest in zip(order, numpy_digests(words)):
+        result[i] = digest
+    return result
+
+
+def sha256_chain_many(values, steps):
+    "sha256_chain of every 32 byte value, steps is a count or a list per value"
+    if isinstance(steps, int):
+        steps = [steps] * len(values)
+    if len(steps) != len(values):
+        raise Exception("sha256_chain_many needs one step count per value")
+    if [x for x in values if len(x) != 32]:
+        raise Exception("sha256_chain_many expects 32 byte values")
+    if (USE_NUMPY and numpy is not None and len(values) >= NUMPY_MIN_LANES
+            and max(steps) > 0):
+        return numpy_sha256_chain_many(values, steps)
+    return [sha256_chain(x, n) for x, n in zip(values, steps)]
+
+
+class HMAC():
+
+    "HMAC with both padded key blocks hashed once, for many messages"
+
+    def __init__(self, key, hashtype=SHA256, max_key_size=None):
+        # Keys longer than max_key_size (the block size by default) are
+        # hashed first
+        if max_key_size is None:
+            max_key_size = hashtype.block_size
+        if len(key) > max_key_size:
+            key = hashtype(key).digest()
+        key = null_padding(key, hashtype.block_size)
+        self.inner_init = hashtype(xor_str(key, '\x36' * hashtype.block_size))
+        self.outer_init = hashtype(xor_str(key, '\x5c' * hashtype.block_size))
+        self.inner = self.inner_init.copy()
+
+    def update(self, data):
+        self.inner.update(data)
+
+    def digest(self):
+        outer = self.outer_init.copy()
+        outer.update(self.inner.digest())
+        return outer.digest()
+
+    def copy(self):
+        other = copy.copy(self)
+        other.inner = self.inner.copy()
+        return other
+
+    def mac(self, data):
+        "HMAC of data alone, independent of any update calls"
+        return self.mac_chunks([data])
+
+    def mac_chunks(self, chunks):
+        "HMAC of the concatenation of chunks, which may be a generator"
+        inner = self.inner_init.copy()
+        for chunk in chunks:
+            inner.update(chunk)
+        outer = self.outer_init.copy()
+        outer.update(inner.digest())
+        return outer.digest()
+
+
+class SHA256_HMAC(HMAC):
+
+    "Incremental Sha256-HMAC, gives the same result as sha256_hmac"
+
+    def __init__(self, key):
+        # Keys of 33-64 bytes are hashed too, unlike standard HMAC
+        HMAC.__init__(self, key, SHA256, 32)
 
 
 def sha256_hmac(data, key):
-    if len(key) > 32:
-        key = sha256(key)
-    key = null_padding(key, 64)
-    o_key_pad = xor_str(key, '\x5c' * 64)
-    i_key_pad = xor_str(key, '\x36' * 64)
-    return sha256(o_key_pad + sha256(i_key_pad + data))
+    "Sha256-HMAC of a single message, keep a SHA256_HMAC to reuse a key"
+    return SHA256_HMAC(key).mac(data)
 
 
 def add_sha256_hmac(encf):
@@ -156,72 +362,106 @@ def check_sha256_hmac(decf):
     return f
 
 
+def verify_sha256_hmac(data_or_file, key):
+    "Check the HMAC at the end of a string or file without decrypting it"
+    length = data_length(data_or_file) - 32
+    if length < 0:
+        return False
+    hmac = SHA256_HMAC(key)
+    for i in range(0, length, FILE_CHUNK_SIZE):
+        hmac.update(read_range(data_or_file, i, min(i + FILE_CHUNK_SIZE, length)))
+    return read_range(data_or_file, length, length + 32) == hmac.digest()
+
+
+sha1_init = [0x67452301, 0xefcdab89, 0x98badcfe, 0x10325476, 0xc3d2e1f0]
+
+
+def sha1_compress(state, chunk):
+    "Apply the SHA1 compression function to a single 64 byte chunk"
+    w = list(struct.unpack(">16I", chunk))
+    for i in range(16, 80):
+        x = w[i - 3] ^ w[i - 8] ^ w[i - 14] ^ w[i - 16]
+        w.append(((x << 1) | (x >> 31)) & 0xffffffff)
+
+    # Five rounds per loop pass, so the working variables trade roles
+    # instead of being shifted along
+    a, b, c, d, e = state
+    for i in range(0, 20, 5):
+        e = (e + ((a << 5) | (a >> 27)) + (d ^ (b & (c ^ d))) + 0x5a827999 + w[i]) & 0xffffffff
+        b = ((b << 30) | (b >> 2)) & 0xffffffff
+        d = (d + ((e << 5) | (e >> 27)) + (c ^ (a & (b ^ c))) + 0x5a827999 + w[i + 1]) & 0xffffffff
+        a = ((a << 30) | (a >> 2)) & 0xffffffff
+        c = (c + ((d << 5) | (d >> 27)) + (b ^ (e & (a ^ b))) + 0x5a827999 + w[i + 2]) & 0xffffffff
+        e = ((e << 30) | (e >> 2)) & 0xffffffff
+        b = (b + ((c << 5) | (c >> 27)) + (a ^ (d & (e ^ a))) + 0x5a827999 + w[i + 3]) & 0xffffffff
+        d = ((d << 30) | (d >> 2)) & 0xffffffff
+        a = (a + ((b << 5) | (b >> 27)) + (e ^ (c & (d ^ e))) + 0x5a827999 + w[i + 4]) & 0xffffffff
+        c = ((c << 30) | (c >> 2)) & 0xffffffff
+    for i in range(20, 40, 5):
+        e = (e + ((a << 5) | (a >> 27)) + (b ^ c ^ d) + 0x6ed9eba1 + w[i]) & 0xffffffff
+        b = ((b << 30) | (b >> 2)) & 0xffffffff
+        d = (d + ((e << 5) | (e >> 27)) + (a ^ b ^ c) + 0x6ed9eba1 + w[i + 1]) & 0xffffffff
+        a = ((a << 30) | (a >> 2)) & 0xffffffff
+        c = (c + ((d << 5) | (d >> 27)) + (e ^ a ^ b) + 0x6ed9eba1 + w[i + 2]) & 0xffffffff
+        e = ((e << 30) | (e >> 2)) & 0xffffffff
+        b = (b + ((c << 5) | (c >> 27)) + (d ^ e ^ a) + 0x6ed9eba1 + w[i + 3]) & 0xffffffff
+        d = ((d << 30) | (d >> 2)) & 0xffffffff
+        a = (a + ((b << 5) | (b >> 27)) + (c ^ d ^ e) + 0x6ed9eba1 + w[i + 4]) & 0xffffffff
+        c = ((c << 30) | (c >> 2)) & 0xffffffff
+    for i in range(40, 60, 5):
+        e = (e + ((a << 5) | (a >> 27)) + ((b & c) | (d & (b | c))) + 0x8f1bbcdc + w[i]) & 0xffffffff
+        b = ((b << 30) | (b >> 2)) & 0xffffffff
+        d = (d + ((e << 5) | (e >> 27)) + ((a & b) | (c & (a | b))) + 0x8f1bbcdc + w[i + 1]) & 0xffffffff
+        a = ((a << 30) | (a >> 2)) & 0xffffffff
+        c = (c + ((d << 5) | (d >> 27)) + ((e & a) | (b & (e | a))) + 0x8f1bbcdc + w[i + 2]) & 0xffffffff
+        e = ((e << 30) | (e >> 2)) & 0xffffffff
+        b = (b + ((c << 5) | (c >> 27)) + ((d & e) | (a & (d | e))) + 0x8f1bbcdc + w[i + 3]) & 0xffffffff
+        d = ((d << 30) | (d >> 2)) & 0xffffffff
+        a = (a + ((b << 5) | (b >> 27)) + ((c & d) | (e & (c | d))) + 0x8f1bbcdc + w[i + 4]) & 0xffffffff
+        c = ((c << 30) | (c >> 2)) & 0xffffffff
+    for i in range(60, 80, 5):
+        e = (e + ((a << 5) | (a >> 27)) + (b ^ c ^ d) + 0xca62c1d6 + w[i]) & 0xffffffff
+        b = ((b << 30) | (b >> 2)) & 0xffffffff
+        d = (d + ((e << 5) | (e >> 27)) + (a ^ b ^ c) + 0xca62c1d6 + w[i + 1]) & 0xffffffff
+        a = ((a << 30) | (a >> 2)) & 0xffffffff
+        c = (c + ((d << 5) | (d >> 27)) + (e ^ a ^ b) + 0xca62c1d6 + w[i + 2]) & 0xffffffff
+        e = ((e << 30) | (e >> 2)) & 0xffffffff
+        b = (b + ((c << 5) | (c >> 27)) + (d ^ e ^ a) + 0xca62c1d6 + w[i + 3]) & 0xffffffff
+        d = ((d << 30) | (d >> 2)) & 0xffffffff
+        a = (a + ((b << 5) | (b >> 27)) + (c ^ d ^ e) + 0xca62c1d6 + w[i + 4]) & 0xffffffff
+        c = ((c << 30) | (c >> 2)) & 0xffffffff
+
+    return [(x + y) & 0xffffffff for x, y in zip(state, [a, b, c, d, e])]
+
+
+class SHA1(HashBase):
+
+    "Incremental Sha1"
+
+    digest_size = 20
+    name = "sha1"
+    init = sha1_init
+    compress = staticmethod(sha1_compress)
+    padding = staticmethod(SHA_padding)
+
+    def encode(self, state):
+        return struct.pack(">5I", *state)
+
+
 def sha1(m):
-    h0 = 0x67452301
-    h1 = 0xefcdab89
-    h2 = 0x98badcfe
-    h3 = 0x10325476
-    h4 = 0xc3d2e1f0
-
-    m = sha_add_length_padding(m)
-
-    for offset in range(0, len(m), 64):
-        chunk = m[offset:offset + 64]
-
-        w = [0 for _ in range(80)]
-        for i in range(0, 16):
-            w[i] = ((ord(chunk[i * 4 + 0]) << 24) +
-                    (ord(chunk[i * 4 + 1]) << 16) +
-                    (ord(chunk[i * 4 + 2]) << 8) +
-                    (ord(chunk[i * 4 + 3]) << 0))
-
-        for i in range(16, 80):
-            w[i] = rotl(w[i - 3] ^ w[i - 8] ^ w[i - 14] ^ w[i - 16], 1)
-
-        a = h0
-        b = h1
-        c = h2
-        d = h3
-        e = h4
-
-        for i in range(0, 80):
-            if i >= 0 and i < 20:
-                f = (b & c) | ((~b) & d)
-                k = 0x5A827999
-            elif i >= 20 and i < 40:
-                f = b ^ c ^ d
-                k = 0x6ED9EBA1
-            elif i >= 40 and i < 60:
-                f = (b & c) | (b & d) | (c & d)
-                k = 0x8F1BBCDC
-            elif i >= 60 and i < 80:
-                f = b ^ c ^ d
-                k = 0xCA62C1D6
-
-            temp = _i32(rotl(a, 5) + f + e + k + w[i])
-            e = d
-            d = c
-            c = rotl(b, 30)
-            b = a
-            a = temp
-
-        h0 = _i32(h0 + a)
-        h1 = _i32(h1 + b)
-        h2 = _i32(h2 + c)
-        h3 = _i32(h3 + d)
-        h4 = _i32(h4 + e)
-
-    return (int2bigendian(h0,4)+
-            int2bigendian(h1,4)+
-            int2bigendian(h2,4)+
-            int2bigendian(h3,4)+
-            int2bigendian(h4,4))
+    return SHA1(m).digest()
 
 
 def sha1_hmac(data, key):
-    if len(key) > 20:
-        key = sha1(key)
-    key = null_padding(key, 20)
-    o_key_pad = xor_str(key, '\x5c' * 20)
-    i_key_pad = xor_str(key, '\x36' * 20)
-    return sha1(o_key_pad + sha1(i_key_pad + data))
+    return HMAC(key, SHA1).mac(data)
+
+
+# hashlib style constructors, sha.new("sha256", data)
+hash_types = {"sha256": SHA256, "sha1": SHA1, "md4": MD4}
+
+
+def new(name, data=""):
+    "Incremental hash object for name (sha256, sha1 or md4)"
+    if name.lower() not in hash_types:
+        raise Exception("Unknown hash type")
+    return hash_types[name.lower()](data)
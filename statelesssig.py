@@ -80,8 +80,8 @@ class PrivateKey():
             self.node_index[d] = crypturd.common.random_mod(self.width)
         # Generate new keys deterministically for each path
         for d2 in range(0,self.depth,1):
-            self.node_keys[d2]  = [onetimesig.new_keys(self.gen_path_seed(d2,ind))
-                                   for ind in range(self.width)]
+            self.node_keys[d2]  = onetimesig.new_keys_many(
+                [self.gen_path_seed(d2,ind) for ind in range(self.width)])
 
     def gen_path_seed(self,depth,index):
         "Deterministically generate a random seed for a one time signature"
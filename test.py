@@ -18,7 +18,9 @@
 # Module for testing all other modules
 
 import crypturd
+import io
 import os
+import signal
 import sys
 import time
 
@@ -71,6 +73,265 @@ def test_aes():
         assert crypturd.common.hexstr(alg("\0" * 16, "\0" * 32)) == result
         bytes_processed += 16
 
+    # Known answers for keyed contexts with both engines. AES-128 is the
+    # FIPS-197 example, AES-256 uses a nonstandard final round key so its
+    # vector is the output of this library for the FIPS-197 key.
+    plaintext = "00112233445566778899aabbccddeeff".decode("hex")
+    for cls, result in [(
+        crypturd.aes.AES128, "69c4e0d86a7b0430d8cdb78070b4c55a"),
+            (crypturd.aes.AES256, "d841b59a3583082a785c947a4e636c83")]:
+        key = "".join([chr(i) for i in range(cls.key_size)])
+        for engine in ["reference", "ttable"]:
+            ctx = cls(key, engine)
+            assert crypturd.common.hexstr(ctx.encrypt_block(plaintext)) == result
+            assert ctx.decrypt_block(result.decode("hex")) == plaintext
+            bytes_processed += 32
+
+        # The T-table engine must match the reference engine
+        key = os.urandom(cls.key_size)
+        ref = cls(key, "reference")
+        ttable = cls(key, "ttable")
+        for _ in range(10):
+            block = os.urandom(16)
+            assert ref.encrypt_block(block) == ttable.encrypt_block(block)
+            assert ref.decrypt_block(block) == ttable.decrypt_block(block)
+            bytes_processed += 64
+
+        # The NumPy batch backend must match the scalar path
+        if crypturd.aes.numpy is not None:
+            data = os.urandom(16 * crypturd.aes.NUMPY_MIN_BLOCKS + 5)
+            counter = os.urandom(16)
+            blocks = data[:-5]
+            crypturd.aes.USE_NUMPY = False
+            scalar = (ctx.encrypt_blocks(blocks), ctx.decrypt_blocks(blocks),
+                      ctx.ctr(data, counter))
+            crypturd.aes.USE_NUMPY = True
+            assert scalar == (ctx.encrypt_blocks(blocks),
+                              ctx.decrypt_blocks(blocks),
+                              ctx.ctr(data, counter))
+            bytes_processed += len(data) * 6
+
+    # The parallel CTR mode must be interchangeable with the serial one
+    key = os.urandom(32)
+    data = os.urandom(1000)
+    counter = os.urandom(16)
+    pool = crypturd.aes.AESPool(crypturd.aes.AES256, key, 2)
+    assert pool.ctr(data, counter, 64) == crypturd.aes.AES256(key).ctr(data, counter)
+
+    # So must the parallel CBC decryption, with and without NumPy
+    blocks = os.urandom(16 * crypturd.aes.NUMPY_MIN_BLOCKS)
+    ciphertext = crypturd.aes.AES256(key).encrypt_cbc(blocks, counter, False)
+    assert pool.decrypt_blocks(ciphertext, 64) == crypturd.aes.AES256(key).decrypt_blocks(ciphertext)
+    for use_numpy in [False, True]:
+        crypturd.aes.USE_NUMPY = use_numpy
+        assert crypturd.aes.AES256(key).decrypt_cbc(ciphertext, counter, False) == blocks
+        assert crypturd.aes.AES256(key).decrypt_cbc(ciphertext, counter, False, pool) == blocks
+        ctx = crypturd.aes.AES256(key)
+        assert ctx.decrypt_cbc_hmac(ctx.encrypt_cbc_hmac(data), pool=pool) == data
+        bytes_processed += len(blocks) * 4
+    pool.close()
+    crypturd.aes.USE_NUMPY = crypturd.aes.numpy is not None
+    for enc, dec in [(crypturd.aes.encrypt_128_ctr_parallel,
+                      crypturd.aes.decrypt_128_ctr),
+                     (crypturd.aes.encrypt_256_ctr,
+                      crypturd.aes.decrypt_256_ctr_parallel)]:
+        assert dec(enc(data, key), key) == data
+        bytes_processed += len(data) * 2
+
+    # Streaming modes must be compatible with the one-shot functions
+    key = os.urandom(33)
+    for plaintext in [os.urandom(j) for j in [0, 16, 33, 1000]]:
+        for enc, dec, enc_file, dec_file in [(
+            crypturd.aes.encrypt_128_ctr, crypturd.aes.decrypt_128_ctr,
+            crypturd.aes.encrypt_128_ctr_file, crypturd.aes.decrypt_128_ctr_file),
+                (crypturd.aes.encrypt_256_cbc, crypturd.aes.decrypt_256_cbc,
+                 crypturd.aes.encrypt_256_cbc_file, crypturd.aes.decrypt_256_cbc_file)]:
+            ciphertext = io.BytesIO()
+            enc_file(io.BytesIO(plaintext), ciphertext, key)
+            assert dec(ciphertext.getvalue(), key) == plaintext
+            output = io.BytesIO()
+            dec_file(io.BytesIO(enc(plaintext, key)), output, key)
+            assert output.getvalue() == plaintext
+            bytes_processed += len(plaintext) * 4
+    stream = crypturd.aes.CTRDecryptor(key)
+    ciphertext = crypturd.aes.encrypt_256_ctr(plaintext, key)
+    plaintext = "".join([stream.update(ciphertext[i:i + 7])
+                         for i in range(0, len(ciphertext), 7)])
+    assert plaintext + stream.finalize() == crypturd.aes.decrypt_256_ctr(ciphertext, key)
+
+    # A keyed context reuses its HMAC and matches the one-shot functions
+    for cls, enc_ctr, dec_ctr, enc_cbc, dec_cbc in [(
+        crypturd.aes.AES128, crypturd.aes.encrypt_128_ctr, crypturd.aes.decrypt_128_ctr,
+        crypturd.aes.encrypt_128_cbc, crypturd.aes.decrypt_128_cbc),
+            (crypturd.aes.AES256, crypturd.aes.encrypt_256_ctr, crypturd.aes.decrypt_256_ctr,
+             crypturd.aes.encrypt_256_cbc, crypturd.aes.decrypt_256_cbc)]:
+        ctx = cls(key)
+        for plaintext in [os.urandom(j) for j in [0, 33, 100]]:
+            assert ctx.decrypt_ctr_hmac(enc_ctr(plaintext, key)) == plaintext
+            assert dec_ctr(ctx.encrypt_ctr_hmac(plaintext), key) == plaintext
+            assert ctx.decrypt_cbc_hmac(enc_cbc(plaintext, key)) == plaintext
+            assert dec_cbc(ctx.encrypt_cbc_hmac(plaintext), key) == plaintext
+            ciphertext = ctx.encrypt_ctr_hmac(plaintext)
+            assert ciphertext[-32:] == crypturd.sha.sha256_hmac(ciphertext[:-32], key)
+            try:
+                ctx.decrypt_ctr_hmac(ciphertext[:-1] + chr(ord(ciphertext[-1]) ^ 1))
+                assert False
+            except Exception as e:
+                assert str(e) == "Invalid HMAC"
+            bytes_processed += len(plaintext) * 8
+        assert ctx.hmac_context() is ctx.hmac_context()
+
+    # Random access into CTR ciphertexts
+    plaintext = os.urandom(1000)
+    for enc, dec_range in [(crypturd.aes.encrypt_128_ctr, crypturd.aes.decrypt_range_128_ctr),
+                           (crypturd.aes.encrypt_256_ctr, crypturd.aes.decrypt_range_256_ctr)]:
+        ciphertext = enc(plaintext, key)
+        assert crypturd.sha.verify_sha256_hmac(io.BytesIO(ciphertext), key)
+        for start, end in [(0, 1000), (0, 1), (15, 17), (333, 800), (990, 2000)]:
+            assert dec_range(ciphertext, key, start, end) == plaintext[start:end]
+            assert dec_range(io.BytesIO(ciphertext), key, start, end) == plaintext[start:end]
+            bytes_processed += (end - start) * 2
+        for start, end in [(-5, 10), (10, 5)]:
+            try:
+                dec_range(ciphertext, key, start, end)
+                assert False
+            except ValueError:
+                pass
+
+    # GCM test cases 2 and 4 from the GCM specification
+    ctx = crypturd.aes.AES128("\0" * 16)
+    assert crypturd.common.hexstr(ctx.encrypt_gcm("\0" * 16, "\0" * 12)) == (
+        "0388dace60b6a392f328c2b971b2fe78ab6e47d42cec13bdf53a67b21257bddf")
+    ctx = crypturd.aes.AES128("feffe9928665731c6d6a8f9467308308")
+    nonce = "\xca\xfe\xba\xbe\xfa\xce\xdb\xad\xde\xca\xf8\x88"
+    plaintext = ("d9313225f88406e5a55909c5aff5269a86a7a9531534f7da2e4c303d8a318a72"
+                 "1c3c0c95956809532fcf0e2449a6b525b16aedf5aa0de657ba637b39")
+    plaintext = "".join([chr(int(plaintext[i:i + 2], 16)) for i in range(0, 120, 2)])
+    aad = "\xfe\xed\xfa\xce\xde\xad\xbe\xef" * 2 + "\xab\xad\xda\xd2"
+    ciphertext = ctx.encrypt_gcm(plaintext, nonce, aad)
+    assert crypturd.common.hexstr(ciphertext) == (
+        "42831ec2217774244b7221b784d0d49ce3aa212f2c02a4e035c17e2329aca12e"
+        "21d514b25466931c7d8f6a5aac84aa051ba30b396a0aac973d58e091"
+        "5bc94fbc3221a5db94fae95ae7121a47")
+    assert ctx.decrypt_gcm(ciphertext, nonce, aad) == plaintext
+    bytes_processed += len(plaintext) * 2 + 32
+
+    # Short messages use bitwise GHASH until the key has hashed enough
+    # blocks to build the tables, both must agree
+    h = crypturd.bigendian2int(os.urandom(16))
+    data = os.urandom(100)
+    assert crypturd.aes.ghash_bitwise(crypturd.aes.ghash_powers(h), 5, data) == (
+        crypturd.aes.ghash(crypturd.aes.ghash_tables(h), 5, data))
+    ctx = crypturd.aes.AES128(os.urandom(16))
+    small = ctx.encrypt_gcm(plaintext, nonce, aad)
+    assert not hasattr(ctx, "ghash_tables")
+    ctx.seal_gcm(os.urandom(16 * crypturd.aes.GHASH_TABLE_BLOCKS))
+    assert hasattr(ctx, "ghash_tables")
+    assert ctx.encrypt_gcm(plaintext, nonce, aad) == small
+    key = ctx.hmac_key
+    assert crypturd.aes.decrypt_128_gcm(ctx.seal_gcm(plaintext, aad), key, aad) == plaintext
+    assert ctx.open_gcm(crypturd.aes.encrypt_128_gcm(plaintext, key, aad), aad) == plaintext
+    bytes_processed += len(plaintext) * 4 + 16 * crypturd.aes.GHASH_TABLE_BLOCKS
+
+    # Writing into preallocated buffers
+    key = os.urandom(32)
+    ctx = crypturd.aes.AES256(key)
+    iv = os.urandom(16)
+    for n in [0, 16, 48, 1 << 15]:
+        plaintext = os.urandom(n)
+        out = bytearray(n + 8)
+        ctx.ctr_into(out, plaintext, iv, 8)
+        assert bytes(out[8:]) == ctx.ctr(plaintext, iv)
+        ctx.encrypt_cbc_into(out, plaintext, iv, 8)
+        assert bytes(out[8:]) == ctx.encrypt_cbc(plaintext, iv, False)
+        ciphertext = bytes(out[8:])
+        ctx.decrypt_cbc_into(out, ciphertext, iv, 8)
+        assert bytes(out[8:]) == plaintext
+        out = bytearray(n + 48)
+        assert crypturd.aes.encrypt_into(out, plaintext, key) == n + 48
+        assert crypturd.aes.decrypt_256_ctr(bytes(out), key) == plaintext
+        result = bytearray(n)
+        assert crypturd.aes.decrypt_into(result, bytes(out), key) == n
+        assert bytes(result) == plaintext
+        bytes_processed += n * 7
+
+    # A buffer without room for the output at the offset is rejected on
+    # both the scalar and the NumPy path instead of being resized
+    use_numpy = crypturd.aes.USE_NUMPY
+    for crypturd.aes.USE_NUMPY in set([False, use_numpy]):
+        data = os.urandom(16 * crypturd.aes.NUMPY_MIN_BLOCKS)
+        for f in [lambda out, offset: ctx.ctr_into(out, data, iv, offset),
+                  lambda out, offset: ctx.encrypt_blocks_into(out, data, offset),
+                  lambda out, offset: ctx.decrypt_blocks_into(out, data, offset),
+                  lambda out, offset: ctx.encrypt_cbc_into(out, data, iv, offset),
+                  lambda out, offset: ctx.decrypt_cbc_into(out, data, iv, offset),
+                  lambda out, offset: ctx.gcm_into(out, data, iv[:12], offset),
+                  lambda out, offset: ctx.encrypt_ctr_hmac_into(out, data[:-48], offset),
+                  lambda out, offset: ctx.encrypt_cbc_hmac_into(out, data[:-64], offset),
+                  lambda out, offset: crypturd.aes.encrypt_into(out, data[:-48], key, offset)]:
+            for size, offset in [(len(data) - 1, 0), (len(data), 1), (5, 20)]:
+                out = bytearray(size)
+                try:
+                    f(out, offset)
+                    assert False
+                except ValueError:
+                    pass
+                assert len(out) == size
+            out = bytearray(len(data) + 7)
+            f(out, 7)
+            assert len(out) == len(data) + 7
+        ciphertext = crypturd.aes.encrypt_256_ctr(data, key)
+        for dec_into in [crypturd.aes.decrypt_256_ctr_into, crypturd.aes.decrypt_into]:
+            try:
+                dec_into(bytearray(len(data)), ciphertext, key, 1)
+                assert False
+            except ValueError:
+                pass
+        bytes_processed += len(data) * 20
+    crypturd.aes.USE_NUMPY = use_numpy
+
+    # All encrypt-then-MAC modes, across several segments
+    for n in [0, 15, 16, 1000, 2 * crypturd.aes.SEGMENT_SIZE + 40]:
+        plaintext = os.urandom(n)
+        for enc_into, dec_into, enc, dec in [(
+            crypturd.aes.encrypt_128_ctr_into, crypturd.aes.decrypt_128_ctr_into,
+            crypturd.aes.encrypt_128_ctr, crypturd.aes.decrypt_128_ctr),
+                (crypturd.aes.encrypt_256_ctr_into, crypturd.aes.decrypt_256_ctr_into,
+                 crypturd.aes.encrypt_256_ctr, crypturd.aes.decrypt_256_ctr),
+                (crypturd.aes.encrypt_128_cbc_into, crypturd.aes.decrypt_128_cbc_into,
+                 crypturd.aes.encrypt_128_cbc, crypturd.aes.decrypt_128_cbc),
+                (crypturd.aes.encrypt_256_cbc_into, crypturd.aes.decrypt_256_cbc_into,
+                 crypturd.aes.encrypt_256_cbc, crypturd.aes.decrypt_256_cbc)]:
+            out = bytearray(n + 64 + 5)
+            length = enc_into(out, plaintext, key, 5)
+            ciphertext = bytes(out[5:5 + length])
+            assert dec(ciphertext, key) == plaintext
+            result = bytearray(len(ciphertext) + 3)
+            assert dec_into(result, ciphertext, key, 3) == n
+            assert bytes(result[3:3 + n]) == plaintext
+            result = bytearray(len(ciphertext))
+            assert dec_into(result, enc(plaintext, key), key) == n
+            assert bytes(result[:n]) == plaintext
+            try:
+                dec_into(result, ciphertext[:-1] + chr(ord(ciphertext[-1]) ^ 1), key)
+                assert False
+            except Exception as e:
+                assert str(e) == "Invalid HMAC"
+            bytes_processed += n * 4
+
+    # The CTR random number generator is plain AES-128-CTR keystream
+    rng = crypturd.aes.RNG_CTR()
+    keystream = rng.aes.ctr("\0" * 100000, rng.counter)
+    assert chr(rng.rand_int8()) == keystream[0]
+    assert rng.rand_bytes(3) == keystream[1:4]
+    assert rng.rand_int32() == int(crypturd.common.hexstr(keystream[4:8]), 16)
+    out = bytearray(1000)
+    rng.fill(out)
+    assert bytes(out) == keystream[8:1008]
+    assert rng.rand_bytes(98992) == keystream[1008:]
+    assert 0 <= crypturd.aes.rand() < 1
+    bytes_processed += len(keystream)
+
     # Test all mode with random data and random keys
     for _ in range(10):
         for key in [os.urandom(i) for i in [0, 5, 16, 32, 33]]:
@@ -85,7 +346,10 @@ def test_aes():
                                  crypturd.aes.decrypt_256_ecb),
                                 (crypturd.aes.encrypt_256_cbc,
                                  crypturd.aes.decrypt_256_cbc),
-                                (crypturd.aes.encrypt_256_ctr, crypturd.aes.decrypt_256_ctr), ]:
+                                (crypturd.aes.encrypt_256_ctr, crypturd.aes.decrypt_256_ctr),
+                                (crypturd.aes.encrypt_128_gcm,
+                                 crypturd.aes.decrypt_128_gcm),
+                                (crypturd.aes.encrypt_256_gcm, crypturd.aes.decrypt_256_gcm), ]:
                     ciphertext = enc(plaintext, key)
                     assert ciphertext != plaintext
                     assert dec(ciphertext, key) == plaintext
@@ -105,11 +369,183 @@ def test_chacha20():
            +'b5129cd1de164eb9cbd083e8a2503c4e')
     assert crypturd.hexstr(ciphertext) == ref
     bytes_processed+=64
+
+    # The NumPy engine must match the scalar one, including counter wraparound
+    if crypturd.chacha20.numpy is not None:
+        for start in [1, 0xfffffffc]:
+            blocks = crypturd.chacha20.numpy_chacha20_blocks(key,start,nonce,9)
+            assert blocks == "".join([crypturd.chacha20.chacha20_block(key,[(start+j)%(1<<32)],nonce)
+                                      for j in range(9)])
+            bytes_processed+=len(blocks)*2
+
+    # So must the multi-process engine
+    data = os.urandom(1000)
+    segment_size = crypturd.chacha20.PARALLEL_SEGMENT_SIZE
+    crypturd.chacha20.PARALLEL_SEGMENT_SIZE = 256
+    assert crypturd.chacha20.parallel_chacha20(key,0xfffffffc,nonce,data,2) == crypturd.xor_str(
+        data, crypturd.chacha20.chacha20_keystream(key,0xfffffffc,nonce,16))
+    threshold = crypturd.chacha20.PARALLEL_THRESHOLD
+    crypturd.chacha20.PARALLEL_THRESHOLD = 256
+    ciphertext = crypturd.chacha20_encrypt(data,"key",parallel=True)
+    assert crypturd.chacha20_decrypt(ciphertext,"key",parallel=True) == data
+    # Without parallel=True no pool is started, whatever the size
+    pool = crypturd.chacha20.multiprocessing.Pool
+    crypturd.chacha20.multiprocessing.Pool = None
+    assert crypturd.chacha20_decrypt(ciphertext,"key") == data
+    crypturd.chacha20.multiprocessing.Pool = pool
+    crypturd.chacha20.PARALLEL_THRESHOLD = threshold
+    crypturd.chacha20.PARALLEL_SEGMENT_SIZE = segment_size
+    bytes_processed+=len(data)*6
     for _ in range(500):
         for key in [os.urandom(i) for i in [0, 5, 16, 32, 33]]:
             for plaintext in [os.urandom(j) for j in [0, 16, 32, 33, 1000]]:
                 assert crypturd.chacha20_decrypt(crypturd.chacha20_encrypt(plaintext,key),key) == plaintext
                 bytes_processed+=len(plaintext)*2
+
+    # Sessions use the same format as chacha20_encrypt
+    session = crypturd.ChaCha20Poly1305Session(key)
+    for plaintext in [os.urandom(j) for j in [0, 16, 33, 1000]]:
+        assert crypturd.chacha20_decrypt(session.seal(plaintext),key) == plaintext
+        assert session.open(crypturd.chacha20_encrypt(plaintext,key)) == plaintext
+        bytes_processed+=len(plaintext)*4
+    nonces = set([session.seal("")[:12] for _ in range(1000)])
+    assert len(nonces) == 1000
+    precomputed = crypturd.ChaCha20PrecomputedSession(key, 4, 2)
+    while precomputed.pool_depth() == 0:
+        time.sleep(0.01)
+    for plaintext in [os.urandom(j) for j in [0, 100, 1000]] * 4:
+        assert crypturd.chacha20_decrypt(precomputed.seal(plaintext),key) == plaintext
+        bytes_processed+=len(plaintext)*2
+    nonces = set([precomputed.seal("")[:12] for _ in range(1000)])
+    assert len(nonces) == 1000
+    assert precomputed.hits > 0 and precomputed.misses > 0
+    precomputed.close()
+    assert precomputed.pool_depth() == 0 and not precomputed.thread.is_alive()
+    with crypturd.ChaCha20PrecomputedSession(key, 4, 2) as precomputed:
+        assert crypturd.chacha20_decrypt(precomputed.seal(plaintext),key) == plaintext
+    # A child forked while the lock is held gets a fresh lock and pool
+    if hasattr(os, "fork"):
+        with crypturd.ChaCha20PrecomputedSession(key, 4, 2) as precomputed:
+            precomputed.seal("")
+            precomputed.lock.acquire()
+            pid = os.fork()
+            if pid == 0:
+                signal.alarm(10)
+                try:
+                    ok = (crypturd.chacha20_decrypt(precomputed.seal("x"),key) == "x"
+                          and precomputed.hits + precomputed.misses == 1)
+                    precomputed.close()
+                finally:
+                    os._exit(0 if ok else 1)
+            precomputed.lock.release()
+            assert os.waitpid(pid, 0)[1] == 0
+    assert precomputed.pool_depth() == 0 and not precomputed.thread.is_alive()
+    ciphertext = session.seal(plaintext)
+    for forged in [ciphertext[:-1]+chr(ord(ciphertext[-1])^1), ciphertext[:27]]:
+        try:
+            session.open(forged)
+            assert False
+        except Exception as e:
+            assert str(e) == "Invalid MAC (Poly1305)"
+
+    # Poly1305 test vector from RFC 7539 section 2.5.2
+    otk = ("85d6be7857556d337f4452fe42d506a8"
+           "0103808afb0db2fd4abff6af4149f51b").decode("hex")
+    assert crypturd.hexstr(crypturd.poly1305("Cryptographic Forum Research Group", otk)) == (
+        "a8061dc1305136c6c22b8baf0c0127a9")
+
+    # Folding several blocks per reduction must match the plain evaluation
+    otk = os.urandom(32)
+    r = crypturd.littleendian2int(otk[:16]) & 0x0ffffffc0ffffffc0ffffffc0fffffff
+    for n in [0, 15, 16, 17, 127, 128, 129, 300]:
+        data = os.urandom(n)
+        accumulator = 0
+        for i in range(0, n, 16):
+            block = data[i:i+16]
+            accumulator = ((accumulator + crypturd.littleendian2int(block) + 2**(len(block)*8)) * r) % ((1 << 130) - 5)
+        accumulator = (accumulator + crypturd.littleendian2int(otk[16:])) % (1 << 128)
+        assert crypturd.poly1305(data, otk) == crypturd.int2littleendian(accumulator, 16)
+        bytes_processed+=n
+
+    # Incremental Poly1305 and streaming encryption
+    data = os.urandom(1000)
+    mac = crypturd.Poly1305(key[:32])
+    for i in range(0, len(data), 7):
+        mac.update(data[i:i+7])
+    assert mac.digest() == crypturd.poly1305(data, key[:32])
+    for plaintext in [os.urandom(j) for j in [0, 16, 64, 65, 1000]]:
+        stream = crypturd.ChaCha20Encryptor(key)
+        ciphertext = "".join([stream.update(plaintext[i:i+13])
+                              for i in range(0, len(plaintext), 13)]) + stream.finalize()
+        assert crypturd.chacha20_decrypt(ciphertext,key) == plaintext
+        stream = crypturd.ChaCha20Decryptor(key)
+        output = "".join([stream.update(ciphertext[i:i+13])
+                          for i in range(0, len(ciphertext), 13)])
+        assert output + stream.finalize() == plaintext
+        output = io.BytesIO()
+        crypturd.chacha20_decrypt_file(io.BytesIO(ciphertext), output, key)
+        assert output.getvalue() == plaintext
+        bytes_processed+=len(plaintext)*6
+
+    # Reduced round variants, all-zero key, nonce and counter
+    for rounds, ref in [
+            (20, "76b8e0ada0f13d90405d6ae55386bd28bdd219b8a08ded1aa836efcc8b770dc7"
+                 "da41597c5157488d7724e03fb8d84a376a43b8f41518a11cc387b669b2ee6586"),
+            (12, "9bf49a6a0755f953811fce125f2683d50429c3bb49e074147e0089a52eae155f"
+                 "0564f879d27ae3c02ce82834acfa8c793a629f2ca0de6919610be82f411326be"),
+            (8, "3e00ef2f895f40d67f5bb8e81f09a5a12c840ec3ce9a7f3b181be188ef711a1e"
+                "984ce172b9216f419f445367456d5619314a42a3da86b001387bfdb80e0cfe42")]:
+        assert crypturd.hexstr(crypturd.chacha20.chacha20_block([0]*8,[0],[0]*3,rounds)) == ref
+        if crypturd.chacha20.numpy is not None:
+            assert crypturd.hexstr(crypturd.chacha20.numpy_chacha20_blocks([0]*8,0,[0]*3,1,rounds)) == ref
+        bytes_processed+=128
+    plaintext = os.urandom(1000)
+    for enc, dec in [(crypturd.chacha8_encrypt, crypturd.chacha8_decrypt),
+                     (crypturd.chacha12_encrypt, crypturd.chacha12_decrypt)]:
+        ciphertext = enc(plaintext,key)
+        assert dec(ciphertext,key) == plaintext
+        try:
+            crypturd.chacha20_decrypt(ciphertext,key)
+            assert False
+        except Exception as e:
+            assert str(e) == "Invalid MAC (Poly1305)"
+        bytes_processed+=len(plaintext)*2
+    seed = os.urandom(56)
+    assert crypturd.chacha8_rand(seed).rand_bytes(64) == crypturd.chacha20.chacha20_block(
+        crypturd.chacha8_rand(seed).key_words,[1],crypturd.chacha8_rand(seed).nonce_words,8)
+
+    # The random number generator serves the key stream in order
+    seed = os.urandom(56)
+    keystream = crypturd.chacha20.chacha20_rand(seed).rand_bytes(100000)
+    rng = crypturd.chacha20.chacha20_rand(seed)
+    assert chr(rng.rand_int8()) == keystream[0]
+    assert rng.rand_bytes(3) == keystream[1:4]
+    assert rng.rand_int32() == crypturd.littleendian2int(keystream[4:8])
+    out = bytearray(1000)
+    rng.fill(out)
+    assert bytes(out) == keystream[8:1008]
+    assert rng.rand_bytes(98992) == keystream[1008:]
+    assert keystream[:64] == crypturd.chacha20.chacha20_block(rng.key_words,[1],rng.nonce_words)
+    bytes_processed+=len(keystream)*2
+
+    # Random access into ciphertexts
+    ciphertext = crypturd.chacha20_encrypt(plaintext,key)
+    assert crypturd.verify_poly1305_mac(io.BytesIO(ciphertext),key)
+    assert not crypturd.verify_poly1305_mac(ciphertext[:-1]+chr(ord(ciphertext[-1])^1),key)
+    for start, end in [(0, 1000), (0, 1), (63, 65), (333, 800), (990, 2000)]:
+        assert crypturd.chacha20_decrypt_range(ciphertext,key,start,end) == plaintext[start:end]
+        assert crypturd.chacha20_decrypt_range(io.BytesIO(ciphertext),key,start,end) == plaintext[start:end]
+        bytes_processed+=(end-start)*2
+    for start, end in [(-5, 10), (10, 5)]:
+        try:
+            crypturd.chacha20_decrypt_range(ciphertext,key,start,end)
+            assert False
+        except ValueError:
+            pass
+    for rounds, enc in [(8, crypturd.chacha8_encrypt), (12, crypturd.chacha12_encrypt)]:
+        ciphertext = enc(plaintext,key)
+        assert crypturd.chacha20_decrypt_range(ciphertext,key,63,800,rounds=rounds) == plaintext[63:800]
+        bytes_processed+=737
     return bytes_processed
 
 
@@ -122,6 +558,42 @@ def test_default():
     plaintext = crypturd.default.decrypt(ciphertext, random_key)
     assert random_data == plaintext
     bytes_processed+=len(plaintext) + len(random_data)
+    ciphertext = io.BytesIO()
+    crypturd.encrypt_file(io.BytesIO(random_data), ciphertext, random_key)
+    plaintext = io.BytesIO()
+    crypturd.decrypt_file(io.BytesIO(ciphertext.getvalue()), plaintext, random_key)
+    assert plaintext.getvalue() == random_data
+    bytes_processed+=len(random_data)*2
+
+    # Segmented format, with small chunks to get several of them
+    chunk_size = crypturd.chacha20.SEGMENT_CHUNK_SIZE
+    threshold = crypturd.chacha20.PARALLEL_THRESHOLD
+    crypturd.chacha20.SEGMENT_CHUNK_SIZE = 64
+    for random_data in [os.urandom(j) for j in [0, 1, 64, 65, 128, 1000]]:
+        ciphertext = crypturd.encrypt_segmented(random_data, random_key)
+        assert len(ciphertext) == 7 + len(random_data) + 16 * max(1, (len(random_data) + 63) // 64)
+        assert crypturd.decrypt_segmented(ciphertext, random_key) == random_data
+        stream = crypturd.chacha20.ChaCha20SegmentedDecryptor(random_key)
+        plaintext = "".join([stream.update(ciphertext[i:i+50])
+                             for i in range(0, len(ciphertext), 50)])
+        assert plaintext + stream.finalize() == random_data
+        output = io.BytesIO()
+        crypturd.encrypt_segmented_file(io.BytesIO(random_data), output, random_key)
+        assert crypturd.decrypt_segmented(output.getvalue(), random_key) == random_data
+        crypturd.chacha20.PARALLEL_THRESHOLD = 0
+        ciphertext_parallel = crypturd.encrypt_segmented(random_data, random_key, parallel=True)
+        assert crypturd.decrypt_segmented(ciphertext_parallel, random_key, parallel=True) == random_data
+        assert crypturd.decrypt_segmented(ciphertext_parallel, random_key) == random_data
+        crypturd.chacha20.PARALLEL_THRESHOLD = threshold
+        # Truncated and modified ciphertexts are rejected
+        for forged in [ciphertext[:-80], ciphertext[:7] + chr(ord(ciphertext[7]) ^ 1) + ciphertext[8:]]:
+            try:
+                crypturd.decrypt_segmented(forged, random_key)
+                assert False
+            except Exception as e:
+                assert str(e) == "Invalid MAC (Poly1305)"
+        bytes_processed+=len(random_data)*8
+    crypturd.chacha20.SEGMENT_CHUNK_SIZE = chunk_size
 
     for _ in range(1000):
         # check that values are in the range 0.0-1.0
@@ -169,6 +641,7 @@ def test_twotimesig():
         new_pk,new_sk,sig = crypturd.twotimesig.full_step(data,sk)
         assert crypturd.twotimesig.verify(data,new_pk,sig,pk)
         assert not crypturd.twotimesig.verify(os.urandom(32),new_pk,sig,pk)
+        assert not crypturd.twotimesig.verify(data,new_pk,sig[:-10],pk)
         pk,sk = new_pk,new_sk
         bytes_processed+=128
     return bytes_processed
@@ -313,6 +786,81 @@ def test_sha():
                  ('12345678901234567890123456789012345678901234567890123456789012345678901234567890', 'f371bc4a311f2b009eef952dd83ca80e2b60026c8e935592d0f9c308453c813e'), ]:
         test_generic_hash(crypturd.sha.sha256, m, h)
         bytes_processed += len(m)
+
+        # Feeding the message in pieces gives the same hash
+        ctx = crypturd.sha.SHA256()
+        for i in range(0, len(m), 7):
+            ctx.update(m[i:i + 7])
+        assert crypturd.common.hexstr(ctx.digest()) == h
+        bytes_processed += len(m)
+
+    # hashlib style objects, a copy continues independently of the original
+    data = os.urandom(1000)
+    for name, f in [("sha256", crypturd.sha.sha256), ("sha1", crypturd.sha.sha1),
+                    ("md4", crypturd.md4)]:
+        ctx = crypturd.sha.new(name, data[:100])
+        for i in range(100, 1000, 99):
+            ctx.update(data[i:i + 99])
+        prefix = crypturd.sha.new(name, data[:500])
+        other = prefix.copy()
+        other.update("x")
+        prefix.update(data[500:])
+        assert ctx.digest() == prefix.digest() == f(data)
+        assert other.hexdigest() == crypturd.common.hexstr(f(data[:500] + "x"))
+        assert len(ctx.digest()) == ctx.digest_size
+        bytes_processed += len(data) * 4
+
+    # HMAC test vectors from RFC 4231 and RFC 2202
+    m = "what do ya want for nothing?"
+    assert crypturd.common.hexstr(crypturd.sha.sha256_hmac(m, "Jefe")) == (
+        "5bdcc146bf60754e6a042426089575c75a003f089d2739839dec58b964ec3843")
+    assert crypturd.common.hexstr(crypturd.sha.sha1_hmac(m, "Jefe")) == (
+        "effcdf6ae5eb2fa2d27416d5f184df9c259a7c79")
+    assert crypturd.common.hexstr(crypturd.sha.sha1_hmac(
+        "Test Using Larger Than Block-Size Key - Hash Key First", "\xaa" * 80)) == (
+        "aa4ae5e15272d00e95705637ce8a3b55ed402112")
+    for key in [os.urandom(i) for i in [0, 20, 32, 33, 64, 65]]:
+        hmac = crypturd.sha.SHA256_HMAC(key)
+        other = hmac.copy()
+        for i in range(0, len(data), 99):
+            hmac.update(data[i:i + 99])
+        assert hmac.digest() == hmac.mac(data) == crypturd.sha.sha256_hmac(data, key)
+        assert other.digest() == crypturd.sha.sha256_hmac("", key)
+        bytes_processed += len(data) * 3
+
+    # Fixed size fast paths agree with the generic hash
+    for _ in range(10):
+        x = os.urandom(32)
+        chain = x
+        for n in range(5):
+            assert crypturd.sha.sha256_chain(x, n) == chain
+            chain = crypturd.sha.sha256(chain)
+        assert crypturd.sha.sha256_32(x) == crypturd.sha.sha256(x)
+        assert crypturd.sha.sha256_64(x + x) == crypturd.sha.sha256(x + x)
+        assert crypturd.sha.sha256_chain(x + "a", 2) == crypturd.sha.sha256(
+            crypturd.sha.sha256(x + "a"))
+        bytes_processed += 32 * 14
+
+    # Batches hashed in lanes match one message at a time, with and
+    # without NumPy
+    use_numpy = crypturd.sha.USE_NUMPY
+    for crypturd.sha.USE_NUMPY in set([False, use_numpy]):
+        for n in [1, 70]:
+            values = [os.urandom(32) for _ in range(n)]
+            steps = [ord(c) % 5 for c in os.urandom(n)]
+            assert crypturd.sha.sha256_many(values) == [crypturd.sha.sha256(x) for x in values]
+            assert crypturd.sha.sha256_chain_many(values, steps) == [
+                crypturd.sha.sha256_chain(x, k) for x, k in zip(values, steps)]
+            messages = [os.urandom(100) for _ in range(n)]
+            assert crypturd.sha.sha256_many(messages) == [crypturd.sha.sha256(m) for m in messages]
+            bytes_processed += n * (32 * 3 + 100 + 32 * sum(steps))
+    crypturd.sha.USE_NUMPY = use_numpy
+
+    # Two one-time keys make enough lanes for the batch key generation
+    sks = [os.urandom(32 * 34) for _ in range(2)]
+    assert crypturd.onetimesig.new_keys_many(sks) == [
+        crypturd.onetimesig.new_keys(sk) for sk in sks]
+    bytes_processed += 2 * 32 * (33 * 256 + 32)
     return bytes_processed
 
 
@@ -361,3 +909,35 @@ def test_all():
     # Reset variables
     crypturd.common.ctlt = True
     crypturd.common.DEBUG = False
+
+
+def benchmark(name, f, data, key):
+    "Time a cipher on random data and print its throughput"
+    sys.stdout.write("%20s: " % name)
+    sys.stdout.flush()
+    t_before = time.time()
+    f(data, key)
+    t_after = time.time()
+    sys.stdout.write(format_bytes_per_second((t_after-t_before), len(data)))
+    sys.stdout.write("\n")
+
+
+def chacha20_scalar_keystream(data, key):
+    "Key stream for data using only the scalar ChaCha20 block function"
+    key_words = [crypturd.littleendian2int(key[i:i + 4]) for i in range(0, 32, 4)]
+    return "".join([crypturd.chacha20.chacha20_block(key_words, [j], [0, 0, 0])
+                    for j in range((len(data) + 63) // 64)])
+
+
+def benchmark_all(size=1 << 16):
+    data = os.urandom(size)
+    key = os.urandom(32)
+    for name, f in [("aes-256-ctr-hmac", crypturd.aes.encrypt_256_ctr),
+                    ("aes-256-cbc-hmac", crypturd.aes.encrypt_256_cbc),
+                    ("aes-256-gcm", crypturd.aes.encrypt_256_gcm),
+                    ("chacha20-poly1305", crypturd.chacha20.chacha20_encrypt),
+                    ("chacha20-scalar", chacha20_scalar_keystream),
+                    ("sha256", lambda data, key: crypturd.sha.sha256(data)),
+                    ("sha1", lambda data, key: crypturd.sha.sha1(data)),
+                    ("sha256-hmac", crypturd.sha.sha256_hmac),]:
+        benchmark(name, f, data, key)
@@ -16,7 +16,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import crypturd
-from crypturd.sha import sha256
+from crypturd.sha import sha256, sha256_32, sha256_chain, sha256_many
 import os
 
 # Very simple post-quantum hash-based signature scheme. The main
@@ -36,21 +36,11 @@ import os
 
 def new_keys():
     "Generate a public/private keypair for hash-based signatures"
-    sk = ""
-    digest1 = ""
-    digest2 = ""
-    # First half
-    for n in range(256):
-        for b in False, True:
-            secret = os.urandom(32)
-            sk += secret
-            digest1 += sha256(secret)
-    # First Second
-    for n in range(256):
-        for b in False, True:
-            secret = os.urandom(32)
-            sk += secret
-            digest2 += sha256(secret)
+    # 256 pairs of secrets for each half, all hashed in one batch
+    sk = os.urandom(32 * 1024)
+    hashes = sha256_many([sk[i:i + 32] for i in range(0, len(sk), 32)])
+    digest1 = "".join(hashes[:512])
+    digest2 = "".join(hashes[512:])
 
     pk = sha256(sha256(digest1)+sha256(digest2))
     return pk, sk
@@ -66,9 +56,9 @@ def sign_left(msg1, sk):
         zero = sk[i * 64:i * 64 + 32]
         one  = sk[i * 64 + 32:i * 64 + 64]
         if ((1 << i) & M1) > 0:
-            zero = crypturd.sha256(zero)
+            zero = sha256_32(zero)
         else:
-            one = crypturd.sha256(one)
+            one = sha256_32(one)
         sig += zero + one
 
     return sig
@@ -83,9 +73,9 @@ def sign_right(msg2, sk):
         zero = sk[i * 64 + 16384:i * 64 + 16416]
         one  = sk[i * 64 + 16416:i * 64 + 16448]
         if ((1 << i) & M2) > 0:
-            zero = crypturd.sha256(zero)
+            zero = sha256_32(zero)
         else:
-            one = crypturd.sha256(one)
+            one = sha256_32(one)
         sig += zero + one
 
     return sig
@@ -108,6 +98,8 @@ def sign(msg1, msg2, sk):
 
 def digest_left(msg1,sig):
     "verify 2 256-bit values using hash-bash signatures (first part)"
+    # Slices of a malformed signature may be short, sha256_chain hashes
+    # those generically so verification fails instead of raising
     msg1 = crypturd.fixed_length_key(msg1, 32)
     digest1 = ""
     M1 = crypturd.bigendian2int(msg1)
@@ -116,9 +108,9 @@ def digest_left(msg1,sig):
         zero = sig[i * 64:i * 64 + 32]
         one  = sig[i * 64 + 32:i * 64 + 64]
         if ((1 << i) & M1) > 0:
-            one = crypturd.sha256(one)
+            one = sha256_chain(one, 1)
         else:
-            zero = crypturd.sha256(zero)
+            zero = sha256_chain(zero, 1)
         digest1 += zero + one
 
     return sha256(digest1)
@@ -133,9 +125,9 @@ def digest_right(msg2,sig):
         zero = sig[i * 64 + 16384:i * 64 + 16416]
         one  = sig[i * 64 + 16416:i * 64 + 16448]
         if ((1 << i) & M2) > 0:
-            one = crypturd.sha256(one)
+            one = sha256_chain(one, 1)
         else:
-            zero = crypturd.sha256(zero)
+            zero = sha256_chain(zero, 1)
         digest2 += zero + one
 
     return sha256(digest2)